@@ -0,0 +1,285 @@
+import numpy as np
+
+##Per-event (not per-hit) columns a PDSPData may carry.
+##link_index/link_row locate each event in the source file:
+##its link in keys and its row in that link's events table.
+##event_key is the packed event id (see event_keys)
+EVENT_COLUMNS = ['events', 'nhits', 'pdg', 'interacted', 'n_neutron',
+                 'n_proton', 'n_piplus', 'n_piminus', 'n_pi0', 'topos',
+                 'link_index', 'link_row', 'event_key']
+
+##Bit widths of run, subrun and event in a packed event key
+EVENT_KEY_BITS = (20, 20, 24)
+
+def pack_event_ids(event_ids):
+  ##One int64 key per (run, subrun, event) row. Keys order like the rows
+  ids = np.asarray(event_ids, dtype=np.int64).reshape(-1, 3)
+  _, subrun_bits, event_bits = EVENT_KEY_BITS
+  limits = 1 << np.array(EVENT_KEY_BITS, dtype=np.int64)
+  if len(ids) and (np.any(ids < 0) or np.any(ids.max(0) >= limits)):
+    raise ValueError(f'Event ids do not fit in {EVENT_KEY_BITS} bits')
+  return ((ids[:, 0] << (subrun_bits + event_bits))
+          | (ids[:, 1] << event_bits) | ids[:, 2])
+
+def event_keys(event_ids):
+  ##pack_event_ids of event_ids, or None if some id does not fit. Data
+  ##without keys is searched row by row instead (see find_event)
+  try:
+    return pack_event_ids(event_ids)
+  except ValueError:
+    return None
+
+def scan_events(events, eid):
+  ##Index of the first row of events equal to eid, -1 if there is none
+  rows = np.flatnonzero(np.all(np.asarray(events).reshape(-1, 3)
+                               == np.asarray(eid).reshape(1, 3), axis=1))
+  return int(rows[0]) if len(rows) else -1
+
+##Storage dtypes of the hit columns (dtypes= of both PDSPData):
+##  coords   -- wire and time numbers, 'int16' or 'int32'
+##  integral -- 'float32' or 'float16'
+##  origin   -- 'packed' keeps each hit's argmax class (origin_class, uint8)
+##              and its beam[, noise] fractions (origin_frac, float16), the
+##              cosmic fraction being the rest; 'float32'/'float64' keep the
+##              (cosmic, beam[, noise]) rows as they are (origin)
+##Hits only take the model's dtypes when a batch is collated (batch_hits)
+DTYPES = {'coords': 'int16', 'integral': 'float32', 'origin': 'packed'}
+DTYPE_CHOICES = {
+  'coords': ['int16', 'int32'],
+  'integral': ['float32', 'float16'],
+  'origin': ['packed', 'float32', 'float64'],
+}
+
+def storage_dtypes(dtypes=None):
+  ##DTYPES with the entries of dtypes in their place
+  dtypes = {**DTYPES, **(dtypes or {})}
+  for n, d in dtypes.items():
+    if d not in DTYPE_CHOICES.get(n, []):
+      raise ValueError(f'Unknown {n} storage dtype {d!r}')
+  return dtypes
+
+def cast_coords(coords, dtype):
+  ##coords as dtype, refusing values it cannot hold
+  info = np.iinfo(dtype)
+  if len(coords) and (coords.min() < info.min or coords.max() > info.max):
+    raise ValueError(f'Hit coordinates do not fit in {dtype}')
+  return coords.astype(dtype)
+
+def origin_columns(origins, dtype):
+  ##Hit columns holding (cosmic, beam[, noise]) origin rows as dtype
+  if dtype != 'packed': return {'origin': origins.astype(dtype)}
+  return {
+    'origin_class': origins.argmax(1).astype(np.uint8),
+    'origin_frac': origins[:, 1:].astype(np.float16),
+  }
+
+def get_origins(plane, i):
+  ##(cosmic, beam[, noise]) rows of event i's hits in plane
+  if 'origin' in plane.columns: return plane.get(i, 'origin')
+  return batch_origins(plane, [i])
+
+def hit_classes(plane, start=0, end=None):
+  ##argmax origin class of the hits of events start:end of plane, and
+  ##the number of classes
+  if end is None: end = len(plane)
+  lo, hi = plane.offsets[start], plane.offsets[end]
+  if 'origin_class' in plane.columns:
+    return (plane.columns['origin_class'][lo:hi],
+            plane.columns['origin_frac'].shape[1] + 1)
+  origin = plane.columns['origin'][lo:hi]
+  return origin.argmax(1), origin.shape[1]
+
+def has_origins(plane):
+  return 'origin' in plane.columns or 'origin_class' in plane.columns
+
+def batch_hits(coords, features):
+  ##Joins the hits of a batch of events into (N, 1 + D) int32 coordinates,
+  ##the first column being the event's place in the batch, and (N, F)
+  ##float32 features -- the one conversion out of the storage dtypes
+  lengths = [len(c) for c in coords]
+  nhits = sum(lengths)
+  batch_coords = np.empty((nhits, coords[0].shape[1] + 1), dtype=np.int32)
+  batch_features = np.empty((nhits, features[0].shape[1]), dtype=np.float32)
+  batch_coords[:, 0] = np.repeat(np.arange(len(coords)), lengths)
+  start = 0
+  for c, f in zip(coords, features):
+    batch_coords[start:start + len(c), 1:] = c
+    batch_features[start:start + len(c)] = f
+    start += len(c)
+  return batch_coords, batch_features
+
+def event_rows(pdsp_data, indices):
+  ##Rows in the planes of pdsp_data of its events indices
+  indices = np.asarray(indices, dtype=np.int64)
+  if hasattr(pdsp_data, 'event_row'): return pdsp_data.event_row(indices)
+  return indices
+
+def batch_planes(planes, rows):
+  ##batch_hits of the events rows of each of planes, gathered straight from
+  ##the stores in one pass over all their hits. The batches are row blocks
+  ##of one coordinate and one feature array
+  gathers = [p.hit_rows(rows) for p in planes]
+  sizes = [len(hits) for hits, _ in gathers]
+  ends = np.cumsum(sizes)
+  batch_coords = np.empty((ends[-1], planes[0].columns['coords'].shape[1] + 1),
+                          dtype=np.int32)
+  batch_features = np.empty((ends[-1], 1), dtype=np.float32)
+  for plane, (hits, offsets), end, size in zip(planes, gathers, ends, sizes):
+    block = slice(end - size, end)
+    batch_coords[block, 0] = np.repeat(np.arange(len(rows)), np.diff(offsets))
+    batch_coords[block, 1:] = plane.columns['coords'][hits]
+    batch_features[block, 0] = plane.columns['integral'][hits]
+  return [(batch_coords[end - size:end], batch_features[end - size:end])
+          for end, size in zip(ends, sizes)]
+
+def batch_plane(plane, rows):
+  ##batch_hits of the events rows of plane, gathered straight from its store
+  return batch_planes([plane], rows)[0]
+
+def batch_origins(plane, rows):
+  ##(cosmic, beam[, noise]) float32 rows of the hits of the events rows
+  ##of plane, in batch_plane's order
+  hits, _ = plane.hit_rows(rows)
+  if 'origin' in plane.columns:
+    return plane.columns['origin'][hits].astype(np.float32)
+  frac = plane.columns['origin_frac']
+  origins = np.empty((len(hits), frac.shape[1] + 1), dtype=np.float32)
+  origins[:, 1:] = frac[hits]
+  origins[:, 0] = 1. - origins[:, 1:].sum(1)
+  return origins
+
+def build_event_index(event_key, live=None):
+  ##(sorted keys, rows) to look events up by key. live leaves rows out
+  rows = (np.arange(len(event_key)) if live is None
+          else np.flatnonzero(live))
+  order = np.argsort(event_key[rows], kind='stable')
+  return np.asarray(event_key[rows][order]), rows[order]
+
+def find_rows(index, keys):
+  ##Row of each key in index (see build_event_index), -1 where absent
+  sorted_keys, rows = index
+  keys = np.atleast_1d(keys)
+  if len(sorted_keys) == 0: return np.full(len(keys), -1, dtype=np.int64)
+  pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+  return np.where(sorted_keys[pos] == keys, rows[pos], -1)
+
+def find_event(pdsp_data, eid):
+  ##Index of the event with id eid (run, subrun, event) among the events
+  ##of pdsp_data, -1 if it is not there. The lookup index is built on the
+  ##first call and again only when event_key changes (e.g. after cleaning).
+  ##Without event keys the events are scanned
+  event_key = getattr(pdsp_data, 'event_key', None)
+  if event_key is None: return scan_events(pdsp_data.events, eid)
+  key = event_keys(eid)
+  if key is None: return -1
+  cached = pdsp_data.__dict__.get('event_index')
+  if cached is None or cached[0] is not event_key:
+    cached = (event_key, build_event_index(event_key))
+    pdsp_data.event_index = cached
+  return int(find_rows(cached[1], key)[0])
+
+def locate_event(pdsp_data, i, row=None):
+  ##Where event i comes from: its link and position in the link's events
+  ##table, and the [start, end) rows of its hits in each loaded plane.
+  ##row is its row in the planes, if that is not i
+  if row is None: row = i
+  return {
+    'link': pdsp_data.keys[int(pdsp_data.link_index[i])],
+    'position': int(pdsp_data.link_row[i]),
+    'hits': {pid: (int(p.offsets[row]), int(p.offsets[row + 1]))
+             for pid, p in enumerate(pdsp_data.planes) if p is not None},
+  }
+
+class PlaneStore:
+  ##Hits of one plane for a list of events, kept as flat columns
+  ##(e.g. coords, integral, origin) plus an offsets array.
+  ##Event i owns rows offsets[i]:offsets[i+1] of every column
+  def __init__(self, columns=None, offsets=None):
+    self.columns = {} if columns is None else columns
+    self.offsets = (np.zeros(1, dtype=np.int64) if offsets is None
+                    else np.asarray(offsets, dtype=np.int64))
+
+  @classmethod
+  def from_lengths(cls, columns, lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return cls(columns, offsets)
+
+  @classmethod
+  def concatenate(cls, stores):
+    ##Joins stores event-wise, in the order given
+    stores = [s for s in stores if s is not None]
+    if len(stores) == 0: return cls()
+
+    names = stores[0].columns.keys()
+    columns = {
+      n: np.concatenate([s.columns[n] for s in stores]) for n in names
+    }
+    lengths = np.concatenate([s.lengths() for s in stores])
+    return cls.from_lengths(columns, lengths)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  @property
+  def nhits(self):
+    return int(self.offsets[-1])
+
+  def lengths(self):
+    return np.diff(self.offsets)
+
+  def get(self, i, name):
+    ##Zero-copy view of event i's hits in column name
+    return self.columns[name][self.offsets[i]:self.offsets[i+1]]
+
+  def hit_rows(self, indices):
+    ##Rows of the hits of the given events, in the given order, and the
+    ##offsets of the events within them
+    indices = np.asarray(indices)
+    indices = (np.flatnonzero(indices) if indices.dtype == bool
+               else indices.astype(np.int64))
+
+    starts = self.offsets[indices]
+    lengths = self.offsets[indices + 1] - starts
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+
+    rows = (np.repeat(starts - new_offsets[:-1], lengths)
+            + np.arange(new_offsets[-1]))
+    return rows, new_offsets
+
+  def take(self, indices):
+    ##New store holding only the given events, in the given order
+    rows, new_offsets = self.hit_rows(indices)
+    return PlaneStore(
+      {n: c[rows] for n, c in self.columns.items()}, new_offsets)
+
+
+def clean_criteria(nhits, pids, pdg=None, check_nhits=True):
+  ##Rejection masks used by clean_events, one per criterion
+  criteria = {}
+  if pdg is not None:
+    criteria['pdg'] = ~np.isin(pdg, [211, -13])
+  if check_nhits:
+    criteria['nhits'] = np.any(nhits[:, pids] == 0, axis=1)
+  return criteria
+
+def report_criteria(criteria, nevents):
+  ##Prints how many events each criterion removes and returns the keep mask
+  keep = np.ones(nevents, dtype=bool)
+  for n, rejected in criteria.items():
+    print(f'Cleaning: {n} removes {np.count_nonzero(rejected)}/{nevents}')
+    keep &= ~rejected
+  print(f'Cleaning: kept {np.count_nonzero(keep)}/{nevents}')
+  return keep
+
+def select_events(pdsp_data, keep):
+  ##Compacts every per-event column and hit store of pdsp_data to the
+  ##events in keep (mask or indices) in one pass
+  for n in EVENT_COLUMNS:
+    if getattr(pdsp_data, n, None) is not None:
+      setattr(pdsp_data, n, getattr(pdsp_data, n)[keep])
+  pdsp_data.planes = [
+    (None if p is None else p.take(keep)) for p in pdsp_data.planes
+  ]
+  pdsp_data.nevents = len(pdsp_data.nhits)
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import numpy as np
+from collections import defaultdict
+from contextlib import contextmanager
+
+##Throughput bookkeeping of load_link. Every process fills the module level
+##`stats` (wall time per stage, bytes read from HDF5, events and hits); the
+##ingest driver takes a record of it after each link and hands the records
+##to an IngestLog, which writes them as JSON lines and sums them up.
+##Stages:
+##  read   -- HDF5 reads
+##  match  -- matching hits to events (group_hits)
+##  encode -- time/origin transforms and noise removal
+##  merge  -- merging duplicate hits
+##  build  -- everything else to assemble a link's arrays
+##  ipc    -- from a worker finishing a link to the result arriving in the
+##            parent (pickling, transfer and waiting to be picked up)
+
+class IngestStats:
+  def __init__(self):
+    self.times = defaultdict(float)
+    self.counts = defaultdict(int)
+
+  @contextmanager
+  def stage(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.times[name] += time.perf_counter() - start
+
+  def read(self, dataset, region=()):
+    ##Reads region (default: all) of an h5 dataset, counting its bytes
+    with self.stage('read'):
+      array = np.asarray(dataset[region])
+    self.counts['bytes'] += array.nbytes
+    return array
+
+  def count(self, **counts):
+    for n, c in counts.items(): self.counts[n] += int(c)
+
+  def take(self):
+    ##Record of everything since the last take, which starts a new one
+    record = {
+      'worker': os.getpid(),
+      'sent': time.time(),
+      'times': dict(self.times),
+      'counts': dict(self.counts),
+    }
+    self.times.clear()
+    self.counts.clear()
+    return record
+
+stats = IngestStats()
+
+def add_into(total, record):
+  for group in ['times', 'counts']:
+    for n, v in record[group].items():
+      total[group][n] = total[group].get(n, 0) + v
+
+def rates(entry, elapsed):
+  ##events/s, hits/s and MB/s over elapsed seconds
+  counts = entry['counts']
+  elapsed = max(elapsed, 1.e-9)
+  return {
+    'events_per_s': counts.get('events', 0)/elapsed,
+    'hits_per_s': counts.get('hits', 0)/elapsed,
+    'mb_per_s': counts.get('bytes', 0)/elapsed/1.e6,
+  }
+
+class IngestLog:
+  ##Per-worker totals of the IngestStats records of one ingest. With path,
+  ##a 'progress' JSON line goes there every interval seconds and a
+  ##'summary' line at the end
+  def __init__(self, path=None, interval=10.):
+    self.path = path
+    self.interval = interval
+    self.start = self.last = time.time()
+    self.workers = {}
+
+  def add(self, record):
+    now = time.time()
+    local = record['worker'] == os.getpid()
+    worker = self.workers.setdefault(
+        'main' if local else str(record['worker']), {'times': {}, 'counts': {}})
+    if not local: record['times']['ipc'] = now - record['sent']
+    add_into(worker, record)
+    if now - self.last >= self.interval:
+      self.last = now
+      self.write('progress')
+
+  def snapshot(self, kind):
+    elapsed = time.time() - self.start
+    total = {'times': {}, 'counts': {}}
+    workers = {}
+    for w, entry in self.workers.items():
+      add_into(total, entry)
+      ##Rates of a worker are over the time it spent on links
+      busy = sum(t for n, t in entry['times'].items() if n != 'ipc')
+      workers[w] = {**entry, 'busy': busy, **rates(entry, busy)}
+    return {
+      'type': kind,
+      'time': time.time(),
+      'elapsed': elapsed,
+      'workers': workers,
+      'total': {**total, **rates(total, elapsed)},
+    }
+
+  def write(self, kind):
+    record = self.snapshot(kind)
+    if self.path is not None:
+      with open(self.path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+  def summary(self):
+    record = self.write('summary')
+    total = record['total']
+    nworkers = max(1, len([w for w in record['workers'] if w != 'main']))
+    stages = ', '.join(f'{n} {t:.2f}s' for n, t in
+                       sorted(total['times'].items(), key=lambda x: -x[1]))
+    print(f'Ingest: {total["counts"].get("links", 0)} links, '
+          f'{total["counts"].get("events", 0)} events, '
+          f'{total["counts"].get("hits", 0)} hits, '
+          f'{total["counts"].get("bytes", 0)/1.e6:.1f} MB '
+          f'in {record["elapsed"]:.2f}s with {nworkers} worker(s): '
+          f'{total["events_per_s"]:.1f} events/s, '
+          f'{total["hits_per_s"]:.0f} hits/s, {total["mb_per_s"]:.1f} MB/s')
+    print(f'Ingest stages (summed over workers): {stages}')
+    return record
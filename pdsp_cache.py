@@ -0,0 +1,435 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import h5py as h5
+from hit_store import (PlaneStore, EVENT_COLUMNS, clean_criteria,
+                       report_criteria, select_events, event_keys,
+                       scan_events,
+                       build_event_index, find_rows, locate_event,
+                       get_origins, hit_classes, has_origins)
+
+##Layout of a cache directory:
+##  meta.json             -- key, ingest parameters, the dtype/shape of
+##                           every column, summary counts of every link it
+##                           holds and, if it can be refreshed, their
+##                           fingerprints
+##  <column>.bin          -- raw array data for the per-event columns
+##  live.bin              -- False for events of links replaced by a refresh
+##  index.keys/rows.bin   -- event keys of the live events, sorted, and their
+##                           rows, to find events by id (see find_rows);
+##                           only when every event id fits in a key
+##  plane<N>.<column>.bin -- flat hit columns and offsets of plane N
+##meta.json is written last: rows past the shapes it records are leftovers
+##of an interrupted refresh and are ignored
+CACHE_VERSION = 3
+
+def cache_key(filename, **params):
+  ##Identifies the source file (by path) together with the parameters the
+  ##ingest was run with. Its contents are tracked per link (see refresh)
+  ident = {
+    'file': os.path.abspath(filename),
+    'version': CACHE_VERSION,
+    **params,
+  }
+  return hashlib.sha1(json.dumps(ident, sort_keys=True).encode()).hexdigest()
+
+def file_ident(filename):
+  st = os.stat(filename)
+  return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+##Groups of a link with one row per event, whose contents are fingerprinted
+EVENT_GROUPS = ['events', 'truth']
+
+def link_fingerprint(group):
+  ##Changes when a dataset of the link is resized, retyped or moved in the
+  ##file, when the size of its stored data changes (e.g. rewritten
+  ##compressed chunks), or when its per-event tables change. Hit values
+  ##rewritten in place are not seen (see refresh). Reads no hits
+  h = hashlib.sha1()
+  def visit(name, obj):
+    if not isinstance(obj, h5.Dataset): return
+    h.update(f'{name}:{obj.shape}:{obj.dtype.str}:{obj.id.get_offset()}:'
+             f'{obj.id.get_storage_size()};'.encode())
+    if name.split('/')[0] in EVENT_GROUPS and obj.shape is not None:
+      h.update(np.ascontiguousarray(obj[()]).tobytes())
+  group.visititems(visit)
+  return h.hexdigest()
+
+def link_fingerprints(filename, keys):
+  ##Fingerprints of the links keys of filename by name, None for its
+  ##other links: those hold no events of the cache and are only tracked
+  ##by name
+  with h5.File(filename, 'r') as h5in:
+    return {k: link_fingerprint(h5in[k]) if k in keys else None
+            for k in h5in.keys()}
+
+def summarize(pdsp_data, start=0, end=None):
+  ##Event, hit and class counts of events start:end of pdsp_data
+  if end is None: end = pdsp_data.nevents
+  info = {
+    'nevents': int(end - start),
+    'nhits': [0 if p is None else int(p.offsets[end] - p.offsets[start])
+              for p in pdsp_data.planes],
+  }
+  if getattr(pdsp_data, 'topos', None) is not None:
+    codes, counts = np.unique(pdsp_data.topos[start:end], return_counts=True)
+    info['topos'] = {str(int(c)): int(n) for c, n in zip(codes, counts)}
+  for pid, p in enumerate(pdsp_data.planes):
+    if p is None or not has_origins(p): continue
+    classes, nclasses = hit_classes(p, start, end)
+    info.setdefault('origins', {})[str(pid)] = np.bincount(
+        classes, minlength=nclasses).tolist()
+  return info
+
+def add_counts(total, info):
+  ##Sums the counts of info into total (same nesting as summarize)
+  for n, v in info.items():
+    if isinstance(v, dict):
+      add_counts(total.setdefault(n, {}), v)
+    elif isinstance(v, list):
+      old = total.get(n, [0]*len(v))
+      total[n] = [a + b for a, b in zip(old, v)]
+    else:
+      total[n] = total.get(n, 0) + v
+  return total
+
+def link_summaries(pdsp_data):
+  ##summarize of the events of each link, by link name.
+  ##Events are grouped by link_index (see PDSPData.set_link_results)
+  keys = getattr(pdsp_data, 'keys', [])
+  if getattr(pdsp_data, 'link_index', None) is None: return {}
+  bounds = np.searchsorted(pdsp_data.link_index, np.arange(len(keys) + 1))
+  return {k: summarize(pdsp_data, bounds[l], bounds[l + 1])
+          for l, k in enumerate(keys) if bounds[l + 1] > bounds[l]}
+
+def total_counts(meta):
+  total = {}
+  for info in meta['link_info'].values(): add_counts(total, info)
+  return total
+
+def get_cache_path(filename, cache_dir, **params):
+  key = cache_key(filename, **params)
+  return os.path.join(cache_dir, f'{os.path.basename(filename)}.{key[:16]}'), key
+
+def read_meta(path):
+  try:
+    with open(os.path.join(path, 'meta.json')) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def is_complete(path, key=None):
+  meta = read_meta(path)
+  if meta is None or meta['version'] != CACHE_VERSION: return False
+  return key is None or meta['key'] == key
+
+def is_current(path, key, filename):
+  ##Complete, and written from filename as it is now
+  return (is_complete(path, key)
+          and read_meta(path)['source'] == file_ident(filename))
+
+def write_meta(path, meta):
+  tmp = os.path.join(path, f'meta.json.tmp{os.getpid()}')
+  with open(tmp, 'w') as f:
+    json.dump(meta, f, indent=1)
+  os.replace(tmp, os.path.join(path, 'meta.json'))
+
+def write_column(path, name, array, meta):
+  array = np.ascontiguousarray(array)
+  array.tofile(os.path.join(path, f'{name}.bin'))
+  meta['columns'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+def replace_column(path, name, array, meta):
+  ##Rewrites a whole column; it only changes once complete
+  tmp = f'{name}.tmp{os.getpid()}'
+  write_column(path, tmp, array, meta)
+  os.replace(os.path.join(path, f'{tmp}.bin'), os.path.join(path, f'{name}.bin'))
+  meta['columns'][name] = meta['columns'].pop(tmp)
+
+def write_index(path, event_key, live, meta):
+  keys, rows = build_event_index(event_key, live)
+  replace_column(path, 'index.keys', keys, meta)
+  replace_column(path, 'index.rows', rows, meta)
+
+def append_column(path, name, array, meta):
+  ##Adds rows to the end of a column, in place
+  info = meta['columns'][name]
+  array = np.ascontiguousarray(array, dtype=info['dtype'])
+  size = int(np.prod(info['shape']))*np.dtype(info['dtype']).itemsize
+  with open(os.path.join(path, f'{name}.bin'), 'r+b') as f:
+    ##Drop anything an interrupted refresh left past the recorded end
+    f.truncate(size)
+    f.seek(size)
+    array.tofile(f)
+  info['shape'][0] += len(array)
+
+def read_column(path, name, meta, mmap=False):
+  info = meta['columns'][name]
+  filename = os.path.join(path, f'{name}.bin')
+  shape = tuple(info['shape'])
+  if mmap:
+    if np.prod(shape) == 0: return np.zeros(shape, dtype=info['dtype'])
+    ##Copy-on-write so the pages are shared but torch sees writable arrays
+    return np.memmap(filename, dtype=info['dtype'], mode='c', shape=shape)
+  return np.fromfile(filename, dtype=info['dtype'],
+                     count=int(np.prod(shape))).reshape(shape)
+
+def save(pdsp_data, path, key='', params={}, filename=None,
+         fingerprint=False):
+  ##Writes the ingested data of pdsp_data to path. With fingerprint, the
+  ##links of filename are fingerprinted so a later refresh can tell what
+  ##changed. The directory only appears once it is complete
+  tmp = f'{path}.tmp{os.getpid()}'
+  if os.path.exists(tmp): shutil.rmtree(tmp)
+  os.makedirs(tmp)
+
+  meta = {
+    'version': CACHE_VERSION,
+    'key': key,
+    'params': params,
+    'nevents': int(pdsp_data.nevents),
+    'links': list(getattr(pdsp_data, 'keys', [])),
+    'source': None if filename is None else file_ident(filename),
+    'fingerprints': (link_fingerprints(filename, pdsp_data.keys)
+                     if fingerprint else {}),
+    'link_info': link_summaries(pdsp_data),
+    'planes': {},
+    'columns': {},
+  }
+  meta['info'] = total_counts(meta)
+  for n in EVENT_COLUMNS:
+    if getattr(pdsp_data, n, None) is not None:
+      write_column(tmp, n, getattr(pdsp_data, n), meta)
+  write_column(tmp, 'live', np.ones(pdsp_data.nevents, dtype=bool), meta)
+  if getattr(pdsp_data, 'event_key', None) is not None:
+    write_index(tmp, pdsp_data.event_key, None, meta)
+
+  for pid, plane in enumerate(pdsp_data.planes):
+    if plane is None: continue
+    meta['planes'][str(pid)] = list(plane.columns.keys())
+    write_column(tmp, f'plane{pid}.offsets', plane.offsets, meta)
+    for n, c in plane.columns.items():
+      write_column(tmp, f'plane{pid}.{n}', c, meta)
+
+  with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+    json.dump(meta, f, indent=1)
+
+  if os.path.exists(path): shutil.rmtree(path)
+  os.replace(tmp, path)
+
+def restore(pdsp_data, path, mmap=False):
+  ##Fills pdsp_data from the cache at path, leaving out replaced events
+  meta = read_meta(path)
+  for n in EVENT_COLUMNS:
+    if n in meta['columns']:
+      setattr(pdsp_data, n, read_column(path, n, meta, mmap))
+
+  pdsp_data.planes = [None, None, None]
+  for pid, names in meta['planes'].items():
+    pdsp_data.planes[int(pid)] = PlaneStore(
+      {n: read_column(path, f'plane{pid}.{n}', meta, mmap) for n in names},
+      read_column(path, f'plane{pid}.offsets', meta, mmap),
+    )
+  pdsp_data.keys = meta['links']
+  pdsp_data.nevents = meta['nevents']
+  pdsp_data.loaded_truth = 'topos' in meta['columns']
+
+  live = read_column(path, 'live', meta)
+  if not np.all(live): select_events(pdsp_data, live)
+  return meta
+
+def refresh(pdsp_data, path, filename, ingest):
+  ##Brings the cache at path up to date with filename. Only links that are
+  ##new or whose fingerprint changed are ingested (ingest(keys) loads them
+  ##into pdsp_data and returns how many events it read) and appended; the
+  ##events of changed or removed links are marked dead in live. Existing
+  ##rows are never rewritten, and nothing is recorded if ingest fails.
+  ##Returns False, changing nothing, if filename changed but no link
+  ##looks changed (e.g. hits rewritten in place): the cache must be rebuilt
+  meta = read_meta(path)
+  old = meta['fingerprints']
+  current = link_fingerprints(filename, [k for k in old if old[k] is not None])
+  stale = set(k for k in old if current.get(k, '') != old[k])
+  new = [k for k in current if k not in old or k in stale]
+  if len(stale) == 0 and len(new) == 0:
+    print(f'{filename} changed but none of its links look changed')
+    return False
+  print(f'Refreshing cache of {filename} in {path}')
+
+  live = read_column(path, 'live', meta)
+  dead = [l for l, k in enumerate(meta['links']) if k in stale]
+  live[np.isin(read_column(path, 'link_index', meta), dead)] = False
+  for k in stale:
+    del old[k]
+    meta['link_info'].pop(k, None)
+
+  added = ingest(new) if len(new) > 0 else 0
+
+  if added > 0:
+    if getattr(pdsp_data, 'event_key', None) is None:
+      ##Some new event id does not fit in a key: no more key lookups
+      for n in ['event_key', 'index.keys', 'index.rows']:
+        meta['columns'].pop(n, None)
+    meta['link_info'].update(link_summaries(pdsp_data))
+    pdsp_data.link_index = pdsp_data.link_index + len(meta['links'])
+    for n in EVENT_COLUMNS:
+      if n in meta['columns']:
+        append_column(path, n, getattr(pdsp_data, n), meta)
+    for pid in meta['planes']:
+      plane = pdsp_data.planes[int(pid)]
+      offsets = read_column(path, f'plane{pid}.offsets', meta, True)
+      append_column(path, f'plane{pid}.offsets',
+                    plane.offsets[1:] + offsets[-1], meta)
+      for n, c in plane.columns.items():
+        append_column(path, f'plane{pid}.{n}', c, meta)
+    meta['links'] += list(pdsp_data.keys)
+    meta['nevents'] += int(added)
+
+  appended = link_fingerprints(filename, pdsp_data.keys if added > 0 else [])
+  old.update({k: appended[k] for k in new})
+  live = np.concatenate([live, np.ones(added, dtype=bool)])
+  replace_column(path, 'live', live, meta)
+  if 'event_key' in meta['columns']:
+    write_index(path, read_column(path, 'event_key', meta), live, meta)
+
+  meta['source'] = file_ident(filename)
+  meta['info'] = total_counts(meta)
+  ##Statistics from pdsp_scan no longer describe the file
+  meta.pop('scan', None)
+  write_meta(path, meta)
+  print(f'Refreshed {path}: {len(new)} new/changed links, '
+        f'{len([k for k in stale if k not in current])} removed, '
+        f'{added} events added')
+  return True
+
+def load_or_ingest(pdsp_data, filename, cache_dir, ingest, params,
+                   load=True, incremental=True):
+  ##Restores pdsp_data from its cache in cache_dir if one matches filename
+  ##and params. Otherwise runs ingest() and writes the cache for next time.
+  ##If filename changed since, an incremental cache is refreshed (see
+  ##refresh) rather than rebuilt where it can be.
+  ##With load=False an existing cache is only located, not read
+  os.makedirs(cache_dir, exist_ok=True)
+  path, key = get_cache_path(filename, cache_dir, **params)
+  if is_current(path, key, filename):
+    print(f'Loading cached {filename} from {path}')
+  elif not (incremental and is_complete(path, key)
+            and refresh(pdsp_data, path, filename, ingest)):
+    ingest()
+    print(f'Writing cache of {filename} to {path}')
+    save(pdsp_data, path, key, params, filename, fingerprint=incremental)
+    return path
+
+  if load: restore(pdsp_data, path)
+  return path
+
+
+class MappedPDSPData:
+  ##Read-only stand-in for PDSPData backed by a cache directory.
+  ##Columns are memory-mapped on first access in each process, so only
+  ##the path is pickled to DataLoader workers and DDP ranks and the OS
+  ##page cache is shared between all of them
+  def __init__(self, path):
+    self.path = path
+    self.meta = read_meta(path)
+    self.nevents = self.meta['nevents']
+    self.nfeatures = self.meta['params'].get('nfeatures', 3)
+    self.keys = self.meta['links']
+    self.index = None
+    live = read_column(path, 'live', self.meta)
+    if not np.all(live):
+      self.index = np.flatnonzero(live)
+      self.nevents = len(self.index)
+
+  def __getstate__(self):
+    return {n: self.__dict__[n] for n in
+            ['path', 'meta', 'nevents', 'nfeatures', 'keys', 'index']}
+
+  def __getattr__(self, name):
+    ##Only reached for columns that have not been opened yet
+    if name.startswith('__') or 'meta' not in self.__dict__:
+      raise AttributeError(name)
+
+    if name == 'planes':
+      self.planes = [None, None, None]
+      for pid, names in self.meta['planes'].items():
+        self.planes[int(pid)] = PlaneStore(
+          {n: read_column(self.path, f'plane{pid}.{n}', self.meta, True)
+           for n in names},
+          read_column(self.path, f'plane{pid}.offsets', self.meta, True),
+        )
+    elif name in EVENT_COLUMNS and name in self.meta['columns']:
+      ##The per-event columns are small -- keep the selected rows in memory
+      column = read_column(self.path, name, self.meta, True)
+      setattr(self, name, column if self.index is None else column[self.index])
+    else:
+      raise AttributeError(name)
+    return self.__dict__[name]
+
+  def event_row(self, eventindex):
+    return eventindex if self.index is None else self.index[eventindex]
+
+  def find_event(self, eid):
+    ##Index of the event with id eid (run, subrun, event) among the
+    ##selected events, -1 if it is not there. A binary search in the
+    ##memory-mapped key index of the cache, or a scan without one
+    if 'index.keys' not in self.meta['columns']:
+      return scan_events(self.events, eid)
+    key = event_keys(eid)
+    if key is None: return -1
+    if 'event_lookup' not in self.__dict__:
+      self.event_lookup = (
+        read_column(self.path, 'index.keys', self.meta, True),
+        read_column(self.path, 'index.rows', self.meta, True),
+      )
+    row = int(find_rows(self.event_lookup, key)[0])
+    if row < 0 or row >= self.meta['nevents']: return -1
+    if self.index is None: return row
+    ##index only ever keeps rows in increasing order
+    i = int(np.searchsorted(self.index, row))
+    return i if i < len(self.index) and self.index[i] == row else -1
+
+  def locate_event(self, i):
+    ##Link, position in the link and hit rows per plane of event i
+    return locate_event(self, i, self.event_row(i))
+
+  def get_plane(self, eventindex, pid):
+    plane = self.planes[pid]
+    row = self.event_row(eventindex)
+    locations = plane.get(row, 'coords')
+    features = plane.get(row, 'integral').reshape(-1, 1)
+    if has_origins(plane):
+      return (locations, features), get_origins(plane, row)
+    return (locations, features)
+
+  def select(self, keep):
+    ##Restricts the events to keep (mask or indices over the current events)
+    index = np.arange(self.nevents)[keep]
+    for n in EVENT_COLUMNS:
+      if n in self.__dict__: setattr(self, n, self.__dict__[n][index])
+    self.index = index if self.index is None else self.index[index]
+    self.nevents = len(self.index)
+
+  def clean_events(self, check_nhits=True):
+    ##Same selection as PDSPData.clean_events, kept as an index over
+    ##the mapped rows rather than a copy of the hits
+    if self.meta['params'].get('type') == 'process_hits':
+      criteria = clean_criteria(self.nhits, [0, 1, 2], self.pdg, check_nhits)
+    else:
+      criteria = clean_criteria(self.nhits, [2], check_nhits=check_nhits)
+    self.select(report_criteria(criteria, self.nevents))
+
+  def get_sample_weights(self):
+    if 'topos' in self.meta['columns']:
+      return 1./np.array([np.sum(self.topos == i) for i in range(4)])
+
+    plane = self.planes[2]
+    classes, _ = hit_classes(plane)
+    ##Count each hit once per selected event it belongs to
+    used = (np.ones(len(plane)) if self.index is None
+            else np.bincount(self.index, minlength=len(plane)))
+    weights = np.repeat(used, plane.lengths())
+    counts = np.bincount(classes, weights=weights, minlength=3)[:self.nfeatures]
+    return np.sum(weights)/counts
@@ -1,17 +1,98 @@
 from torch.utils.data import Dataset, DataLoader
 
-import MinkowskiEngine as ME
-
 import torch
 import torch.nn as nn
+import numpy as np
 
-import process_hits
+import pdsp_cache
+from hit_store import batch_hits, batch_plane, batch_planes, event_rows
+from pdsp_sampler import (HitBudgetBatchSampler, HitBalancedSampler,
+                          event_hits)
 from dataclasses import dataclass
 
 @dataclass
 class Config:
   batch_size: int
   num_workers: int = 1
+  pin_memory: bool = False
+  persistent_workers: bool = False
+  prefetch_factor: int = 2
+  max_batch_hits: int = 0
+  bucket_size: int = 0
+
+def worker_init_fn(worker_id):
+  ##Workers are forked (the default on Linux) with the dataset already in
+  ##memory, so there is nothing to load here. Each one only reads and
+  ##copies hits: keep it to one thread so num_workers workers do not
+  ##oversubscribe the cores left to the training process
+  torch.set_num_threads(1)
+  np.random.seed(torch.utils.data.get_worker_info().seed % 2**32)
+
+def preload_planes(pdsp_data, pids):
+  ##Reads any lazily loaded planes of pids now, before DataLoader workers
+  ##start (see PDSPBase.load_planes); a mapped cache has none
+  if hasattr(pdsp_data, 'load_planes'): pdsp_data.load_planes(pids)
+
+def add_loader_args(parser, num_workers=1):
+  ##Command line options of the ingest (see Selection and load_cached)
+  ##and of the DataLoader (see loader_options and batch_options), shared by
+  ##the training scripts
+  parser.add_argument('--cache_dir', type=str, default=None,
+                      help='Reuse/write preprocessed samples in this directory')
+  parser.add_argument('--link_fraction', type=float, default=1.,
+                      help='Only ingest this (deterministic) fraction of links')
+  parser.add_argument('--max_events', type=int, default=-1,
+                      help='Only ingest this many events')
+  parser.add_argument('--num_workers', type=int, default=num_workers,
+                      help='DataLoader worker processes')
+  parser.add_argument('--pin_memory', action='store_true',
+                      help='Collate batches into page-locked memory')
+  parser.add_argument('--persistent_workers', action='store_true',
+                      help='Keep DataLoader workers up between epochs')
+  parser.add_argument('--prefetch_factor', type=int, default=2,
+                      help='Batches each worker loads ahead')
+  parser.add_argument('--max_batch_hits', type=int, default=0,
+                      help=('Fill batches up to this many hits (with at most '
+                            '--batch_size events) instead of --batch_size events'))
+  parser.add_argument('--bucket_size', type=int, default=0,
+                      help=('With --max_batch_hits, batch events of similar '
+                            'size from runs of this many events'))
+  parser.add_argument('--prefetch_depth', type=int, default=2,
+                      help=('Batches whose model inputs are built ahead on a '
+                            'background thread (0: none)'))
+  parser.add_argument('--ingest_stats', type=str, default=None,
+                      help='Append ingest throughput records (JSON lines) here')
+
+def loader_options(config):
+  ##DataLoader worker settings of config (a Config or the parsed command
+  ##line). Workers stay up between epochs with persistent_workers, so the
+  ##dataset is only handed to them once
+  options = {'num_workers': config.num_workers,
+             'pin_memory': config.pin_memory}
+  if config.num_workers > 0:
+    options.update(
+      persistent_workers=config.persistent_workers,
+      prefetch_factor=config.prefetch_factor,
+      worker_init_fn=worker_init_fn,
+    )
+  return options
+
+def batch_options(dataset, config, pids=[2], distributed=False):
+  ##How the DataLoader forms batches: config.batch_size events at a time
+  ##or, with config.max_batch_hits, as many events (up to batch_size) as
+  ##fit in that many hits of the planes pids. distributed shards (and
+  ##shuffles) them over the DDP ranks, evening out the hits per rank
+  hits = event_hits(dataset.pdsp_data, pids)
+  if config.max_batch_hits > 0:
+    return {'batch_sampler': HitBudgetBatchSampler(
+      hits, config.max_batch_hits,
+      max_events=config.batch_size, shuffle=distributed,
+      bucket_size=config.bucket_size,
+      num_replicas=None if distributed else 1,
+      rank=None if distributed else 0,
+    )}
+  return {'batch_size': config.batch_size,
+          'sampler': HitBalancedSampler(hits) if distributed else None}
 
 
 ##Only uses plane 2
@@ -19,31 +100,57 @@ class PDSPDataset(Dataset):
   def __init__(self, pdsp_data):
     super().__init__()
     self.pdsp_data = pdsp_data
+    preload_planes(pdsp_data, [2])
 
   def __len__(self):
     return self.pdsp_data.nevents
 
   def __getitem__(self, i: int) -> dict:
+    ##Views in the storage dtypes -- minkowski_collate_fn converts them
     locs, features = self.pdsp_data.get_plane(i, 2)
     label = self.pdsp_data.topos[i]
 
     return {
-      'coordinates': torch.from_numpy(locs).to(torch.long),
-      'features': torch.from_numpy(features).to(torch.float32),
-      'label': torch.LongTensor([label])
+      'coordinates': locs,
+      'features': features,
+      'label': label
     }
 
+  def __getitems__(self, indices) -> dict:
+    ##A whole batch at once: the DataLoader hands its indices here (instead
+    ##of one __getitem__ per event) and minkowski_collate_fn passes the
+    ##result through. Hits are copied from the store straight into the
+    ##batch arrays
+    coordinates, features = batch_plane(
+        self.pdsp_data.planes[2], event_rows(self.pdsp_data, indices))
+    labels = np.asarray(self.pdsp_data.topos)[indices].astype(np.int64)
+    return {
+      'coordinates': torch.from_numpy(coordinates),
+      'features': torch.from_numpy(features),
+      'labels': torch.from_numpy(labels),
+    }
+
+##Same as PDSPDataset, but reads events on demand from a
+##memory-mapped cache directory (see pdsp_cache) instead of RAM
+class MappedPDSPDataset(PDSPDataset):
+  def __init__(self, path, clean=True):
+    pdsp_data = pdsp_cache.MappedPDSPData(path)
+    if clean: pdsp_data.clean_events()
+    super().__init__(pdsp_data)
+
 def minkowski_collate_fn(list_data):
-    coordinates_batch, features_batch, labels_batch = ME.utils.sparse_collate(
+    ##The hits only leave their storage dtypes here, once per batch.
+    ##Batches from PDSPDataset.__getitems__ are collated already
+    if isinstance(list_data, dict): return list_data
+    coordinates_batch, features_batch = batch_hits(
         [d["coordinates"] for d in list_data],
         [d["features"] for d in list_data],
-        [d["label"] for d in list_data],
-        dtype=torch.float32,
     )
+    labels_batch = np.array([d["label"] for d in list_data], dtype=np.int64)
     return {
-        "coordinates": coordinates_batch,
-        "features": features_batch,
-        "labels": labels_batch,
+        "coordinates": torch.from_numpy(coordinates_batch),
+        "features": torch.from_numpy(features_batch),
+        "labels": torch.from_numpy(labels_batch),
     }
 
 def get_dataset(pdsp_data):
@@ -55,9 +162,9 @@ def get_loader(pdsp_data, config):
 
   return DataLoader(
     dataset,
-    num_workers=1, ##config.num_workers
     collate_fn=minkowski_collate_fn,
-    batch_size=config.batch_size,
+    **batch_options(dataset, config),
+    **loader_options(config),
   )
 
 
@@ -65,6 +172,7 @@ class PDSPDatasetAllPlanes(Dataset):
   def __init__(self, pdsp_data):
     super().__init__()
     self.pdsp_data = pdsp_data
+    preload_planes(pdsp_data, [0, 1, 2])
 
   def __len__(self):
     return self.pdsp_data.nevents
@@ -73,18 +181,33 @@ class PDSPDatasetAllPlanes(Dataset):
 
     label = self.pdsp_data.topos[i]
     data = {
-     'label' :torch.LongTensor([label])
+     'label' :label
     }
 
     for j in range(3):
       locs, features = self.pdsp_data.get_plane(i, j)
-      data[f'coordinates_{j}'] = torch.from_numpy(locs).to(torch.long)
-      data[f'features_{j}'] = torch.from_numpy(features).to(torch.float32)
+      data[f'coordinates_{j}'] = locs
+      data[f'features_{j}'] = features
+    return data
+
+  def __getitems__(self, indices) -> dict:
+    ##A whole batch at once, as in PDSPDataset.__getitems__: all three
+    ##planes are gathered in one pass into one coordinate and one feature
+    ##array, which the per-plane tensors share
+    batches = batch_planes(self.pdsp_data.planes,
+                           event_rows(self.pdsp_data, indices))
+    labels = np.asarray(self.pdsp_data.topos)[indices].astype(np.int64)
+    data = {'labels': torch.from_numpy(labels)}
+    for j, (coordinates, features) in enumerate(batches):
+      data[f'coordinates_{j}'] = torch.from_numpy(coordinates)
+      data[f'features_{j}'] = torch.from_numpy(features)
     return data
 
 def get_dataset_allplanes(pdsp_data):
   return PDSPDatasetAllPlanes(pdsp_data)
 def minkowski_collate_fn_all_planes(list_data):
+    ##Batches from PDSPDatasetAllPlanes.__getitems__ are collated already
+    if isinstance(list_data, dict): return list_data
 
     coordinates_0 = []
     coordinates_1 = []
@@ -106,31 +229,17 @@ def minkowski_collate_fn_all_planes(list_data):
 
       labels.append(d['label'])
 
-    coordinates_0, features_0, labels = ME.utils.sparse_collate(
-        coordinates_0,
-        features_0,
-        labels,
-        dtype=torch.float32,
-    )
-
-    coordinates_1, features_1 = ME.utils.sparse_collate(
-        coordinates_1,
-        features_1,
-        dtype=torch.float32,
-    )
-
-    coordinates_2, features_2 = ME.utils.sparse_collate(
-        coordinates_2,
-        features_2,
-        dtype=torch.float32,
-    )
+    coordinates_0, features_0 = batch_hits(coordinates_0, features_0)
+    coordinates_1, features_1 = batch_hits(coordinates_1, features_1)
+    coordinates_2, features_2 = batch_hits(coordinates_2, features_2)
+    labels = np.array(labels, dtype=np.int64)
 
     return {
-        "coordinates_0": coordinates_0,
-        "features_0": features_0,
-        "coordinates_1": coordinates_1,
-        "features_1": features_1,
-        "coordinates_2": coordinates_2,
-        "features_2": features_2,
-        "labels": labels,
+        "coordinates_0": torch.from_numpy(coordinates_0),
+        "features_0": torch.from_numpy(features_0),
+        "coordinates_1": torch.from_numpy(coordinates_1),
+        "features_1": torch.from_numpy(features_1),
+        "coordinates_2": torch.from_numpy(coordinates_2),
+        "features_2": torch.from_numpy(features_2),
+        "labels": torch.from_numpy(labels),
     }
@@ -1,17 +1,24 @@
 from torch.utils.data import Dataset, DataLoader
 
-import MinkowskiEngine as ME
-
 import torch
 import torch.nn as nn
+import numpy as np
 
 #import process_all_hits
+import pdsp_cache
+from hit_store import batch_hits, batch_plane, batch_origins, event_rows
+from pdsp_dataset_mink import loader_options, batch_options, preload_planes
 from dataclasses import dataclass
 
 @dataclass
 class Config:
   batch_size: int
   num_workers: int = 1
+  pin_memory: bool = False
+  persistent_workers: bool = False
+  prefetch_factor: int = 2
+  max_batch_hits: int = 0
+  bucket_size: int = 0
   use_dpp: bool = False
 
 
@@ -20,31 +27,59 @@ class PDSPDataset(Dataset):
   def __init__(self, pdsp_data):
     super().__init__()
     self.pdsp_data = pdsp_data
+    preload_planes(pdsp_data, [2])
 
   def __len__(self):
     return self.pdsp_data.nevents
 
   def __getitem__(self, i: int) -> dict:
+    ##Arrays in the storage dtypes -- minkowski_collate_fn converts them
     (locs, features), label = self.pdsp_data.get_plane(i, 2)
     #label = self.pdsp_data.topos[i]
 
     return {
-      'coordinates': torch.from_numpy(locs).to(torch.long),
-      'features': torch.from_numpy(features).to(torch.float32),
-      'label': torch.from_numpy(label).to(torch.float32)
+      'coordinates': locs,
+      'features': features,
+      'label': label
     }
 
+  def __getitems__(self, indices) -> dict:
+    ##A whole batch at once: the DataLoader hands its indices here (instead
+    ##of one __getitem__ per event) and minkowski_collate_fn passes the
+    ##result through. Hits are copied from the store straight into the
+    ##batch arrays
+    plane = self.pdsp_data.planes[2]
+    rows = event_rows(self.pdsp_data, indices)
+    coordinates, features = batch_plane(plane, rows)
+    return {
+      'coordinates': torch.from_numpy(coordinates),
+      'features': torch.from_numpy(features),
+      'labels': torch.from_numpy(batch_origins(plane, rows)),
+    }
+
+##Same as PDSPDataset, but reads events on demand from a
+##memory-mapped cache directory (see pdsp_cache) instead of RAM
+class MappedPDSPDataset(PDSPDataset):
+  def __init__(self, path, clean=True):
+    pdsp_data = pdsp_cache.MappedPDSPData(path)
+    if clean: pdsp_data.clean_events()
+    super().__init__(pdsp_data)
+
 def minkowski_collate_fn(list_data):
-    coordinates_batch, features_batch, labels_batch = ME.utils.sparse_collate(
+    ##The hits only leave their storage dtypes here, once per batch.
+    ##Labels are the per-hit origin rows. Batches from
+    ##PDSPDataset.__getitems__ are collated already
+    if isinstance(list_data, dict): return list_data
+    coordinates_batch, features_batch = batch_hits(
         [d["coordinates"] for d in list_data],
         [d["features"] for d in list_data],
-        [d["label"] for d in list_data],
-        dtype=torch.float32,
     )
+    labels_batch = np.concatenate([d["label"] for d in list_data]).astype(
+        np.float32, copy=False)
     return {
-        "coordinates": coordinates_batch,
-        "features": features_batch,
-        "labels": labels_batch,
+        "coordinates": torch.from_numpy(coordinates_batch),
+        "features": torch.from_numpy(features_batch),
+        "labels": torch.from_numpy(labels_batch),
     }
 
 def get_dataset(pdsp_data):
@@ -56,10 +91,9 @@ def get_loader(pdsp_data, config):
 
   return DataLoader(
     dataset,
-    num_workers=1, ##config.num_workers
     collate_fn=minkowski_collate_fn,
-    batch_size=config.batch_size,
-    sampler=None,
+    **batch_options(dataset, config),
+    **loader_options(config),
     #sampler=(DistributedSampler(dataset)
     #         if (torch.cuda.is_available() and config.use_ddp)
     #         else None)
@@ -0,0 +1,104 @@
+import time
+import queue
+import threading
+import torch
+
+##Keeps the next batches' model inputs ready while the current step runs.
+##A background thread pulls batches from the DataLoader, copies them to
+##the device and builds the inputs (e.g. ME.SparseTensor, whose coordinate
+##hashing would otherwise sit right before the forward pass). The copies
+##and kernels it queues go on the device's default stream, in order with
+##the training step's, so no memory is reused before the step is done
+##with it; pinning, launching and building move off the critical path
+
+def to_device(tensor, device):
+  ##tensor on device; from pinned memory, so the copy does not block
+  if torch.device(device).type != 'cuda': return tensor.to(device)
+  if not tensor.is_pinned(): tensor = tensor.pin_memory()
+  return tensor.to(device, non_blocking=True)
+
+class Prefetcher:
+  ##Iterates over loader as (batch, prepare(batch)) pairs, with up to depth
+  ##pairs prepared ahead on a background thread. prepare runs there with
+  ##device as the current CUDA device (the current device is per thread,
+  ##and ME allocates and launches on it). starved counts the batches the
+  ##training loop found nothing ready for, waited the seconds it spent
+  ##waiting for them (both over the last pass)
+  END = object()
+
+  def __init__(self, loader, prepare, depth=2, device=None):
+    self.loader = loader
+    self.prepare = prepare
+    self.depth = depth
+    self.device = device
+    self.starved = 0
+    self.waited = 0.
+    self.batches = 0
+
+  def __len__(self):
+    return len(self.loader)
+
+  def put(self, q, stop, item):
+    ##Blocks until there is room for item, unless the consumer has stopped
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def cuda_index(self):
+    ##Index of the CUDA device to prepare on, None if not on CUDA. Called
+    ##on the training thread, whose current device 'cuda' stands for
+    if self.device is None or not torch.cuda.is_available(): return None
+    device = torch.device(self.device)
+    if device.type != 'cuda': return None
+    return torch.cuda.current_device() if device.index is None else device.index
+
+  def fill(self, q, stop, index):
+    try:
+      if index is not None: torch.cuda.set_device(index)
+      for data in self.loader:
+        if not self.put(q, stop, (data, self.prepare(data))): return
+    except Exception as e:
+      self.put(q, stop, e)
+      return
+    self.put(q, stop, self.END)
+
+  def __iter__(self):
+    self.starved, self.waited, self.batches = 0, 0., 0
+    if self.depth <= 0:
+      ##No thread: every batch is prepared while the loop waits
+      for data in self.loader:
+        start = time.perf_counter()
+        item = (data, self.prepare(data))
+        self.starved += 1
+        self.waited += time.perf_counter() - start
+        self.batches += 1
+        yield item
+      return
+
+    q = queue.Queue(maxsize=self.depth)
+    stop = threading.Event()
+    thread = threading.Thread(target=self.fill,
+                              args=(q, stop, self.cuda_index()), daemon=True)
+    thread.start()
+    try:
+      while True:
+        start = time.perf_counter()
+        empty = q.empty()
+        item = q.get()
+        if item is self.END: break
+        if isinstance(item, Exception): raise item
+        self.starved += empty
+        self.waited += time.perf_counter() - start
+        self.batches += 1
+        yield item
+    finally:
+      stop.set()
+      thread.join()
+
+  def report(self):
+    print(f'Prefetch: {self.starved}/{self.batches} batches not ready in '
+          f'time, {self.waited:.2f}s waiting (depth {self.depth})')
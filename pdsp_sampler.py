@@ -0,0 +1,167 @@
+import heapq
+import numpy as np
+import torch.distributed as dist
+
+##Samplers that look at how many hits each event has, so batches (and
+##ranks) carry similar amounts of work rather than similar event counts.
+##Like DistributedSampler, their order depends on seed and on the epoch
+##given to set_epoch, which every rank must call with the same value
+
+def event_hits(pdsp_data, pids=[2]):
+  ##Hits of each event summed over the planes pids
+  return np.asarray(pdsp_data.nhits)[:, pids].sum(1)
+
+def replicas(num_replicas=None, rank=None):
+  ##(num_replicas, rank), by default from the initialised process group
+  if num_replicas is None:
+    num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+  if rank is None:
+    rank = dist.get_rank() if dist.is_initialized() else 0
+  return num_replicas, rank
+
+def pack_batches(hits, order, max_hits, max_events=None):
+  ##Splits order into consecutive batches of at most max_hits hits (and
+  ##max_events events). An event over max_hits gets a batch of its own
+  batches, batch, total = [], [], 0
+  for i in order:
+    full = max_events is not None and len(batch) >= max_events
+    if batch and (full or total + hits[i] > max_hits):
+      batches.append(batch)
+      batch, total = [], 0
+    batch.append(int(i))
+    total += hits[i]
+  if batch: batches.append(batch)
+  return batches
+
+class HitBudgetBatchSampler:
+  ##Batches of up to max_hits hits (and max_events events) for the
+  ##batch_sampler of a DataLoader. hits holds each event's hit count
+  ##(see event_hits).
+  ##With shuffle, events are drawn in a random order; with bucket_size,
+  ##each run of bucket_size drawn events is sorted by hits before packing,
+  ##so batches hold events of similar size, and the batches are shuffled
+  ##again afterwards.
+  ##Every rank packs the same batches and takes every num_replicas-th,
+  ##repeating the first ones so all ranks get the same number of steps
+  ##(or, with drop_last, leaving the rest out)
+  def __init__(self, hits, max_hits, max_events=None, shuffle=True,
+               bucket_size=0, seed=0, num_replicas=None, rank=None,
+               drop_last=False):
+    self.hits = np.asarray(hits)
+    self.max_hits = max_hits
+    self.max_events = max_events
+    self.shuffle = shuffle
+    self.bucket_size = bucket_size
+    self.seed = seed
+    self.num_replicas, self.rank = replicas(num_replicas, rank)
+    self.drop_last = drop_last
+    self.epoch = 0
+    self.batches = None
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+    self.batches = None
+
+  def make_batches(self):
+    ##This rank's batches for the current epoch
+    rng = np.random.default_rng([self.seed, self.epoch])
+    order = (rng.permutation(len(self.hits)) if self.shuffle
+             else np.arange(len(self.hits)))
+    if self.bucket_size > 0:
+      order = np.concatenate([
+        bucket[np.argsort(self.hits[bucket], kind='stable')]
+        for bucket in np.split(order, range(self.bucket_size, len(order),
+                                            self.bucket_size))
+      ])
+    batches = pack_batches(self.hits, order, self.max_hits, self.max_events)
+    if self.shuffle and self.bucket_size > 0:
+      batches = [batches[b] for b in rng.permutation(len(batches))]
+
+    nbatches = len(batches)//self.num_replicas
+    if not self.drop_last and len(batches) > 0:
+      nbatches = -(-len(batches)//self.num_replicas)
+      extra = nbatches*self.num_replicas - len(batches)
+      batches += (batches*(extra//len(batches) + 1))[:extra]
+    return batches[self.rank:nbatches*self.num_replicas:self.num_replicas]
+
+  def get_batches(self):
+    if self.batches is None: self.batches = self.make_batches()
+    return self.batches
+
+  def __iter__(self):
+    return iter(self.get_batches())
+
+  def __len__(self):
+    return len(self.get_batches())
+
+class HitBalancedSampler:
+  ##DistributedSampler that splits each epoch's events so every rank gets
+  ##the same number of events (hence of steps) and close to the same total
+  ##hits: events go out heaviest first, each to the rank with the fewest
+  ##hits so far among those with room left (greedy LPT with a cap on the
+  ##events per rank). Each rank's share is then shuffled. Events are
+  ##repeated to fill up the last round, or left out with drop_last.
+  ##The per-rank hit totals of the last epoch are kept in stats and
+  ##printed by rank 0
+  def __init__(self, hits, num_replicas=None, rank=None, shuffle=True,
+               seed=0, drop_last=False):
+    self.hits = np.asarray(hits)
+    self.num_replicas, self.rank = replicas(num_replicas, rank)
+    self.shuffle = shuffle
+    self.seed = seed
+    self.drop_last = drop_last
+    self.epoch = 0
+    self.stats = None
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def partition(self):
+    ##Events of every rank for the current epoch, (num_replicas, n)
+    nreplicas = self.num_replicas
+    rng = np.random.default_rng([self.seed, self.epoch])
+    order = (rng.permutation(len(self.hits)) if self.shuffle
+             else np.arange(len(self.hits)))
+    if self.drop_last:
+      order = order[:len(order) - len(order) % nreplicas]
+    elif len(order) % nreplicas:
+      extra = nreplicas - len(order) % nreplicas
+      order = np.concatenate([order, np.resize(order, extra)])
+
+    ##Heaviest first; ties keep the shuffled order
+    order = order[np.argsort(-self.hits[order], kind='stable')]
+    nevents = len(order)//nreplicas
+    shares = np.empty((nreplicas, nevents), dtype=order.dtype)
+    counts = [0]*nreplicas
+    ##(hits, rank) of the ranks with room left; ties go to the lower rank
+    lightest = [(0, r) for r in range(nreplicas)]
+    for i, hits in zip(order.tolist(), self.hits[order].tolist()):
+      load, r = heapq.heappop(lightest)
+      shares[r, counts[r]] = i
+      counts[r] += 1
+      if counts[r] < nevents: heapq.heappush(lightest, (load + hits, r))
+    if self.shuffle:
+      for share in shares: rng.shuffle(share)
+    return shares
+
+  def log(self, shares):
+    loads = self.hits[shares].sum(1)
+    mean = loads.mean()
+    self.stats = {
+      'epoch': self.epoch,
+      'hits': loads.tolist(),
+      'imbalance': float(loads.max()/mean - 1.) if mean > 0 else 0.,
+    }
+    if self.rank == 0:
+      print(f'Epoch {self.epoch}: {shares.shape[1]} events and '
+            f'{loads.min()}-{loads.max()} hits per rank, '
+            f'{100*self.stats["imbalance"]:.2f}% over the mean')
+
+  def __iter__(self):
+    shares = self.partition()
+    self.log(shares)
+    return iter(shares[self.rank].tolist())
+
+  def __len__(self):
+    if self.drop_last: return len(self.hits)//self.num_replicas
+    return -(-len(self.hits)//self.num_replicas)
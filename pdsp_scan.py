@@ -0,0 +1,140 @@
+import os
+import json
+import numpy as np
+from argparse import ArgumentParser as ap
+
+import h5py as h5
+from hit_store import clean_criteria
+from process_hits import Selection, group_hits, read_truth, get_topos
+from process_all_hits import encode_origins
+
+##Dataset statistics and class weights without ingesting any hits.
+##One pass over the links reads events/nhits and truth/* and, for
+##process_all_hits, the plane's origin column in chunks of chunk_size hits,
+##so memory stays bounded by the largest link's event tables.
+##The result matches what get_sample_weights gives after a full ingest and
+##clean_events, except that process_all_hits counts hits before duplicate
+##hits are merged (the scan never reads wire/time)
+
+def origin_classes(raw_origin, nfeatures):
+  ##argmax class of each hit's encoded origin; noise hits are dropped
+  ##(class -1) when nfeatures < 3, as build_plane_data does
+  classes = encode_origins(raw_origin, 3).argmax(1)
+  if nfeatures < 3: classes[raw_origin < 0] = -1
+  return classes
+
+def count_origins(group, pid, nfeatures, events=None, chunk_size=1 << 20):
+  ##Hit counts per origin class of a link's plane, read chunk_size hits at a
+  ##time. With events, only hits of those events count
+  hits = group[f'plane_{pid}_hits']
+  counts = np.zeros(3, dtype=np.int64)
+  for start in range(0, hits['origin'].shape[0], chunk_size):
+    raw_origin = np.asarray(hits['origin'][start:start + chunk_size]).flatten()
+    if events is not None:
+      rows, _ = group_hits(events,
+                           hits['event_id'][start:start + chunk_size])
+      raw_origin = raw_origin[rows]
+    classes = origin_classes(raw_origin, nfeatures)
+    counts += np.bincount(classes[classes >= 0], minlength=3)
+  return counts
+
+def scan(filename, kind='process_hits', selection=None, nfeatures=3,
+         clean=True, pid=2, bin_width=50, nbins=200, chunk_size=1 << 20):
+  ##Returns {'type', 'nevents', 'nhits_hist', 'weights'} plus 'topos'
+  ##(process_hits: events per topology 0-3) or 'origins' (process_all_hits:
+  ##hits per origin class of plane pid). nhits_hist holds per-plane event
+  ##counts in bins of bin_width hits, the last bin taking the overflow.
+  ##clean applies the clean_events criteria
+  if selection is None: selection = Selection()
+  result = {
+    'type': kind,
+    'nevents': 0,
+    'nhits_hist': {'bin_width': bin_width,
+                   'counts': np.zeros((3, nbins), dtype=np.int64)},
+  }
+  topos = np.zeros(5, dtype=np.int64)
+  origins = np.zeros(3, dtype=np.int64)
+
+  with h5.File(filename, 'r') as h5in:
+    for k, rows, nhits in selection.links(h5in, list(h5in.keys())):
+      group = h5in[k]
+      if rows is not None: nhits = nhits[rows]
+
+      if kind == 'process_hits':
+        truth = read_truth(group)
+        if rows is not None: truth = {n: t[rows] for n, t in truth.items()}
+        criteria = (clean_criteria(nhits, [0, 1, 2], truth['pdg'])
+                    if clean else {})
+      else:
+        criteria = clean_criteria(nhits, [pid]) if clean else {}
+      keep = np.ones(len(nhits), dtype=bool)
+      for rejected in criteria.values(): keep &= ~rejected
+      if not np.any(keep): continue
+
+      result['nevents'] += int(np.count_nonzero(keep))
+      bins = np.minimum(nhits[keep] // bin_width, nbins - 1)
+      for p in range(3):
+        result['nhits_hist']['counts'][p] += np.bincount(bins[:, p],
+                                                         minlength=nbins)
+
+      if kind == 'process_hits':
+        codes = get_topos(truth['pdg'], truth['interacted'], truth['n_piplus'],
+                          truth['n_piminus'], truth['n_pi0'])[keep]
+        topos += np.bincount(codes + 1, minlength=5)
+      else:
+        ##Only read event ids when some of the link's events are left out
+        events = None
+        if rows is not None or not np.all(keep):
+          events = np.array(group['events/event_id'])
+          if rows is not None: events = events[rows]
+          events = events[keep]
+        origins += count_origins(group, pid, nfeatures, events, chunk_size)
+
+  result['nhits_hist']['counts'] = result['nhits_hist']['counts'].tolist()
+  with np.errstate(divide='ignore'):
+    if kind == 'process_hits':
+      result['topos'] = topos[1:].tolist()
+      result['weights'] = (1./topos[1:]).tolist()
+    else:
+      result['origins'] = origins[:nfeatures].tolist()
+      result['weights'] = (origins.sum()/origins[:nfeatures]).tolist()
+  return result
+
+def store(path, result):
+  ##Keeps result as 'scan' in the meta of a cache directory, or in the
+  ##manifest of a preprocess.py output directory
+  name = ('manifest.json' if os.path.exists(os.path.join(path, 'manifest.json'))
+          else 'meta.json')
+  with open(os.path.join(path, name)) as f:
+    meta = json.load(f)
+  meta['scan'] = result
+  tmp = os.path.join(path, f'{name}.tmp{os.getpid()}')
+  with open(tmp, 'w') as f:
+    json.dump(meta, f, indent=1)
+  os.replace(tmp, os.path.join(path, name))
+
+if __name__ == '__main__':
+  parser = ap()
+  parser.add_argument('file')
+  parser.add_argument('--type', default='process_hits',
+                      choices=['process_hits', 'process_all_hits'])
+  parser.add_argument('--nfeatures', type=int, default=3,
+                      help='process_all_hits only')
+  parser.add_argument('--noclean', action='store_true')
+  parser.add_argument('--bin_width', type=int, default=50)
+  parser.add_argument('--nbins', type=int, default=200)
+  parser.add_argument('--link_fraction', type=float, default=1.,
+                      help='Only scan this (deterministic) fraction of links')
+  parser.add_argument('--max_events', type=int, default=-1,
+                      help='Only scan this many events')
+  parser.add_argument('--store', type=str, default=None,
+                      help='Cache or preprocess.py directory to keep the result in')
+  args = parser.parse_args()
+
+  selection = Selection(link_fraction=args.link_fraction,
+                        max_events=args.max_events)
+  result = scan(args.file, args.type, selection, args.nfeatures,
+                clean=not args.noclean, bin_width=args.bin_width,
+                nbins=args.nbins)
+  if args.store: store(args.store, result)
+  print(json.dumps({n: v for n, v in result.items() if n != 'nhits_hist'}))
@@ -0,0 +1,238 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+import multiprocessing as mp
+from math import ceil
+from argparse import ArgumentParser as ap
+
+import h5py as h5
+import pdsp_cache
+import process_hits
+import process_all_hits
+from process_hits import Selection, run_plan
+from hit_store import (event_keys, find_rows, storage_dtypes, DTYPES,
+                       DTYPE_CHOICES)
+
+##Preprocesses many HDF5 files into shards under one output directory:
+##  <file>.<hash>.<NNNN>/ -- one shard, a cache directory (see pdsp_cache)
+##                     that MappedPDSPData/MappedPDSPDataset read directly;
+##                     hash tells apart files with the same name
+##  manifest.json   -- parameters, and event/hit/class counts of every shard
+##  index.*.bin     -- every event's key, shard and row, sorted by key
+##                     (see SampleIndex)
+##Each file is split on its own into shards of about --shard_hits hits, so
+##new or changed files never reshuffle the shards of the others. Shards that
+##already exist with the same file (unmodified), links and parameters are
+##skipped.
+MANIFEST_VERSION = 1
+
+def make_data(params):
+  if params['type'] == 'process_hits':
+    return process_hits.PDSPData(maxtime=params['maxtime'], linked=True,
+                                 dtypes=params['dtypes'])
+  return process_all_hits.PDSPData(maxtime=params['maxtime'],
+                                   nfeatures=params['nfeatures'],
+                                   dtypes=params['dtypes'])
+
+def shard_name(filename, i):
+  ##Name of shard i of filename, unique to its absolute path
+  path_hash = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+  return f'{os.path.basename(filename)}.{path_hash[:8]}.{i:04d}'
+
+def scan_file(job):
+  ##Selection.plan of one file -- reads events/nhits and truth only
+  filename, selection = job
+  with h5.File(filename, 'r') as h5in:
+    return selection.plan(h5in, [k for k in h5in.keys()])
+
+def partition(plan, shard_hits):
+  ##Splits the links of plan into ceil(hits/shard_hits) shards with
+  ##(close to) equal hits: largest link first onto the lightest shard.
+  ##Links keep their file order within a shard
+  sizes = np.array([size for _, _, size in plan])
+  nshards = min(len(plan), max(1, ceil(sizes.sum()/shard_hits)))
+  loads = np.zeros(nshards)
+  shards = [[] for _ in range(nshards)]
+  for i in np.argsort(-sizes, kind='stable'):
+    s = int(np.argmin(loads))
+    shards[s].append(i)
+    loads[s] += sizes[i]
+  return [[plan[i] for i in sorted(s)] for s in shards]
+
+def run_shard(job):
+  filename, plan, path, key, params = job
+  pdsp_data = make_data(params)
+  pdsp_data.keys = [k for k, _, _ in plan]
+  pdsp_data.set_link_results(
+      run_plan(pdsp_data, filename, plan, pids=params['planes']))
+  pdsp_cache.save(pdsp_data, path, key, params, filename)
+  return path
+
+def read_manifest(output_dir):
+  try:
+    with open(os.path.join(output_dir, 'manifest.json')) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def write_manifest(output_dir, manifest):
+  tmp = os.path.join(output_dir, f'manifest.json.tmp{os.getpid()}')
+  with open(tmp, 'w') as f:
+    json.dump(manifest, f, indent=1)
+  os.replace(tmp, os.path.join(output_dir, 'manifest.json'))
+
+def write_sample_index(output_dir, shards, manifest):
+  ##Joins the key indexes of all shards into one for the whole output
+  keys, shard_ids, rows = [], [], []
+  for s, shard in enumerate(shards):
+    path = os.path.join(output_dir, shard['name'])
+    meta = pdsp_cache.read_meta(path)
+    if 'index.keys' not in meta['columns']: continue
+    keys.append(pdsp_cache.read_column(path, 'index.keys', meta))
+    rows.append(pdsp_cache.read_column(path, 'index.rows', meta))
+    shard_ids.append(np.full(len(keys[-1]), s, dtype=np.int32))
+
+  columns = {
+    n: np.concatenate(c) if len(c) else np.zeros(0, dtype=np.int64)
+    for n, c in [('keys', keys), ('shards', shard_ids), ('rows', rows)]
+  }
+  order = np.argsort(columns['keys'], kind='stable')
+  manifest['index'] = {'columns': {}}
+  for n, c in columns.items():
+    pdsp_cache.write_column(output_dir, f'index.{n}', c[order],
+                            manifest['index'])
+
+class SampleIndex:
+  ##Finds events by id across all shards of a preprocess output, with a
+  ##binary search in the memory-mapped index
+  def __init__(self, output_dir):
+    self.output_dir = output_dir
+    self.manifest = read_manifest(output_dir)
+    meta = self.manifest['index']
+    self.keys, self.shards, self.rows = [
+      pdsp_cache.read_column(output_dir, f'index.{n}', meta, True)
+      for n in ['keys', 'shards', 'rows']
+    ]
+
+  def find(self, eid):
+    ##(shard name, row in the shard) of event eid, None if absent. Shards
+    ##whose ids do not all fit in keys are not indexed
+    key = event_keys(eid)
+    if key is None: return None
+    pos = int(find_rows((self.keys, np.arange(len(self.keys))), key)[0])
+    if pos < 0: return None
+    shard = self.manifest['shards'][int(self.shards[pos])]['name']
+    return shard, int(self.rows[pos])
+
+  def locate(self, eid):
+    ##find, plus the event's link, position and hit rows (see locate_event)
+    found = self.find(eid)
+    if found is None: return None
+    shard, row = found
+    data = pdsp_cache.MappedPDSPData(os.path.join(self.output_dir, shard))
+    return {'shard': shard, 'row': row, **data.locate_event(row)}
+
+def preprocess(files, output_dir, params, selection, shard_hits,
+               num_workers=1):
+  os.makedirs(output_dir, exist_ok=True)
+  with mp.Pool(num_workers) as pool:
+    plans = pool.map(scan_file, [(f, selection) for f in files])
+
+    shards, jobs = [], []
+    for filename, plan in zip(files, plans):
+      if len(plan) == 0:
+        print(f'No events selected in {filename}')
+        continue
+      for i, shard_plan in enumerate(partition(plan, shard_hits)):
+        name = shard_name(filename, i)
+        path = os.path.join(output_dir, name)
+        key = pdsp_cache.cache_key(filename, **params,
+                                   links=[k for k, _, _ in shard_plan])
+        shards.append({'name': name, 'file': os.path.abspath(filename),
+                       'links': len(shard_plan)})
+        if pdsp_cache.is_current(path, key, filename): continue
+        jobs.append((filename, shard_plan, path, key, params))
+
+    print(f'{len(shards) - len(jobs)}/{len(shards)} shards already complete')
+    ##Largest shards first so the pool is not left waiting on one at the end
+    jobs.sort(key=lambda j: -sum(size for _, _, size in j[1]))
+    for a, path in enumerate(pool.imap_unordered(run_shard, jobs)):
+      print(f'{a + 1}/{len(jobs)} wrote {path}')
+
+  ##Drop the shards of a previous run that are no longer part of the output
+  names = set(s['name'] for s in shards)
+  old = read_manifest(output_dir)
+  for s in ([] if old is None else old['shards']):
+    if s['name'] not in names:
+      shutil.rmtree(os.path.join(output_dir, s['name']), ignore_errors=True)
+
+  totals = {}
+  for s in shards:
+    info = pdsp_cache.read_meta(os.path.join(output_dir, s['name']))['info']
+    s.update(info)
+    pdsp_cache.add_counts(totals, info)
+  manifest = {
+    'version': MANIFEST_VERSION,
+    'params': params,
+    'files': [os.path.abspath(f) for f in files],
+    'shards': shards,
+    'totals': totals,
+  }
+  write_sample_index(output_dir, shards, manifest)
+  write_manifest(output_dir, manifest)
+  return manifest
+
+if __name__ == '__main__':
+  parser = ap()
+  parser.add_argument('files', nargs='+',
+                      help='Input HDF5 files or glob patterns')
+  parser.add_argument('--output_dir', required=True)
+  parser.add_argument('--type', default='process_hits',
+                      choices=['process_hits', 'process_all_hits'])
+  parser.add_argument('--maxtime', type=int, default=913)
+  parser.add_argument('--nfeatures', type=int, default=3,
+                      help='process_all_hits only')
+  parser.add_argument('--coords_dtype', default=DTYPES['coords'],
+                      choices=DTYPE_CHOICES['coords'])
+  parser.add_argument('--integral_dtype', default=DTYPES['integral'],
+                      choices=DTYPE_CHOICES['integral'])
+  parser.add_argument('--origin_dtype', default=DTYPES['origin'],
+                      choices=DTYPE_CHOICES['origin'],
+                      help='process_all_hits only (see hit_store.DTYPES)')
+  parser.add_argument('--planes', nargs='+', type=int, default=None,
+                      help='Default: 0 1 2 (process_hits), 2 (process_all_hits)')
+  parser.add_argument('--shard_hits', type=int, default=10000000,
+                      help='Target number of hits per shard')
+  parser.add_argument('--num_workers', type=int, default=4)
+  parser.add_argument('--link_fraction', type=float, default=1.,
+                      help='Only ingest this (deterministic) fraction of links')
+  parser.add_argument('--max_events', type=int, default=-1,
+                      help='Only ingest this many events of each file')
+  args = parser.parse_args()
+
+  ##Once per file, however it is named
+  files = sorted(set(os.path.abspath(f) for pattern in args.files
+                     for f in (glob.glob(pattern) or [pattern])))
+  planes = args.planes
+  if planes is None: planes = [0, 1, 2] if args.type == 'process_hits' else [2]
+
+  selection = Selection(link_fraction=args.link_fraction,
+                        max_events=args.max_events)
+  params = {
+    'type': args.type,
+    'maxtime': args.maxtime,
+    'dtypes': storage_dtypes({'coords': args.coords_dtype,
+                              'integral': args.integral_dtype,
+                              'origin': args.origin_dtype}),
+    'planes': sorted(planes),
+    'selection': selection.params(),
+  }
+  if args.type == 'process_hits': params['linked'] = True
+  else: params['nfeatures'] = args.nfeatures
+
+  manifest = preprocess(files, args.output_dir, params, selection,
+                        args.shard_hits, args.num_workers)
+  print(json.dumps(manifest['totals']))
@@ -1,7 +1,11 @@
 import numpy as np
 from math import ceil, sqrt, exp, pi
-import h5py as h5
-import multiprocessing as mp
+from process_hits import (match_hits, get_event_rows, read_rows, Selection,
+                          PDSPBase)
+from hit_store import (PlaneStore, clean_criteria, report_criteria,
+                       select_events, event_keys, storage_dtypes,
+                       cast_coords, origin_columns, get_origins, hit_classes)
+from ingest_stats import stats
 
 class PlaneData:
   def __init__(self, wire, time, integral, origin):
@@ -10,214 +14,169 @@ class PlaneData:
     self.integral = integral
     self.origin = origin
 
-class PDSPData:
-  def __init__(self, maxtime=913, maxwires=[800, 800, 480], nfeatures=3):
+def encode_origins(raw_origin, nfeatures):
+  ##raw_origin is the beam fraction of each hit, negative for noise.
+  ##Returns (cosmic, beam[, noise]) fractions per hit
+  origins = np.zeros((len(raw_origin), nfeatures))
+  beam = raw_origin >= 0
+  origins[beam, 0] = 1. - raw_origin[beam]
+  origins[beam, 1] = raw_origin[beam]
+  if nfeatures == 3:
+    origins[raw_origin < 0, 2] = 1.
+  return origins
+
+def merge_duplicates(event_index, wire, time, integral, origins):
+  ##Merges hits sharing (event, wire, time) in a single pass.
+  ##Integrals are summed and the origins are weighted by integral.
+  ##The merged hit takes the place of the first of its duplicates.
+  ##Returns the indices of the kept hits with their merged integrals/origins
+  if len(wire) == 0:
+    return np.arange(0), integral, origins
+
+  ##Pack (event, wire, time) into one integer key
+  wire_off = wire - wire.min()
+  time_off = time - time.min()
+  nwires = int(wire_off.max()) + 1
+  ntimes = int(time_off.max()) + 1
+  key = (event_index.astype(np.int64)*nwires + wire_off)*ntimes + time_off
+
+  _, first, inverse, counts = np.unique(
+      key, return_index=True, return_inverse=True, return_counts=True)
+  inverse = inverse.reshape(-1)
+
+  summed = np.bincount(inverse, weights=integral)
+  weighted = np.stack([
+    np.bincount(inverse, weights=origins[:, j]*integral)
+    for j in range(origins.shape[1])
+  ], axis=1)
+
+  ##Keep the original hit order
+  emit = np.argsort(first, kind='stable')
+  keep = first[emit]
+  dup = (counts > 1)[emit]
+
+  merged_integral = integral[keep]
+  merged_integral[dup] = summed[emit][dup]
+  merged_origins = origins[keep]
+  merged_origins[dup] = weighted[emit][dup] / summed[emit][dup].reshape(-1, 1)
+  return keep, merged_integral, merged_origins
+
+class PDSPData(PDSPBase):
+  def __init__(self, maxtime=913, maxwires=[800, 800, 480], nfeatures=3,
+               stats_file=None, dtypes=None):
     self.maxtime=maxtime
     self.maxwires=maxwires
     self.nfeatures=nfeatures
-
-  def find_duplicates(self, coords):
-    u, counts = np.unique(coords, return_counts=True, axis=0)
-    duplicate_indices = []
-    dups = np.where(counts > 1)
-    if len(dups) == 0: return
-
-    for i in np.where(counts > 1)[0]:
-      #print(i, u[i])
-      #print(np.where(np.all(coords == u[i], axis=1)))
-
-      duplicate_indices.append(np.where(np.all(coords == u[i], axis=1))[0])
-    duplicate_indices = np.array(duplicate_indices)
-    return duplicate_indices
+    ##Storage dtypes of the hit columns (see hit_store.DTYPES)
+    self.dtypes = storage_dtypes(dtypes)
+    ##JSON lines of ingest throughput go here (see ingest_stats)
+    self.stats_file = stats_file
 
   def get_plane_data(self, h5in, k, eid, pid):
     ##To-Do: check maxtime and wires
-    #events = np.array(h5in[f'{k}/events/event_id'][:])
-    hit_events = np.array(h5in[f'{k}/plane_{pid}_hits/event_id'][:])
-    #print(hit_events)
-    #print(eid)
-    indices = np.all(hit_events == eid, axis=1)
-    #print(np.array(h5in[f'{k}/plane_{pid}_hits']['wire'])[indices].flatten().astype(int))
-
-    temp_origin = np.array(h5in[f'{k}/plane_{pid}_hits']['origin'])[indices].flatten()
-    origins = np.zeros((*temp_origin.shape, self.nfeatures))
-
-    if self.nfeatures == 3:
-      origins[np.where(temp_origin < 0), 2] = 1.
-
-    origins[np.where(temp_origin >= 0), 0] = 1. - temp_origin[np.where(temp_origin >= 0)]
-    origins[np.where(temp_origin >= 0), 1] = temp_origin[np.where(temp_origin >= 0)]
-
-    plane_data = PlaneData(
-               np.array(h5in[f'{k}/plane_{pid}_hits']['wire'])[indices].flatten().astype(int),
-               (912 - (np.array(h5in[f'{k}/plane_{pid}_hits']['time'])[indices]- 500.)/6.025).flatten().astype(int),
-               np.array(h5in[f'{k}/plane_{pid}_hits']['integral'])[indices].flatten(),
-               origins 
-           )
-
-    if self.nfeatures < 3:
-      to_del = np.where(np.sum(origins, axis=1) == 0.)
-      #print(to_del)
-      #print(plane_data.origin[to_del])
-      if len(to_del) > 0:
-        plane_data.time = np.delete(plane_data.time, to_del)
-        plane_data.wire = np.delete(plane_data.wire, to_del)
-        plane_data.integral = np.delete(plane_data.integral, to_del)
-        plane_data.origin = np.delete(plane_data.origin, to_del, axis=0)
-
-    coords = np.zeros((len(plane_data.wire), 2))
-    coords[:, 0] = plane_data.wire
-    coords[:, 1] = plane_data.time
-
-    duplicate_indices = self.find_duplicates(coords)
-    #print(self.duplicate_indices)
-
-    to_del = []
-    for i in range(len(duplicate_indices)):
-      #print(i, self.duplicate_indices[i])
-      #print(plane_data.integral[self.duplicate_indices[i]])
-      #print(plane_data.origin[self.duplicate_indices[i]])
-      dups = duplicate_indices[i]
-      dups.sort()
-
-      ##Weight the origins by the integral size
-      plane_data.origin[dups] *= plane_data.integral[dups].reshape(*plane_data.integral[dups].shape, 1)
-      plane_data.integral[dups[0]] = np.sum(plane_data.integral[dups])
-      plane_data.origin[dups[0]] = np.sum(plane_data.origin[dups], axis=0)
-      plane_data.origin[dups[0]] /= plane_data.integral[dups[0]]
-      #print(plane_data.integral[dups[0]])
-      #print(plane_data.origin[dups[0]])
-      to_del += [i for i in dups[1:]]
-    #to_del = np.array(to_del).flatten()
-    #print(k, eid, to_del)
-    to_del.sort()
-    #print(to_del)
-
-    
-
-    #to_del = np.where((plane_data.time >= self.maxtime) |
-    #                  (plane_data.wire >= self.maxwires[pid]))
-
-    #print('Wire', pid, plane_data.wire)
-    #print('Time', pid, plane_data.time)
-    #print('ToD', pid, to_del)
-    if len(to_del) > 0:
-      plane_data.time = np.delete(plane_data.time, to_del)
-      plane_data.wire = np.delete(plane_data.wire, to_del)
-      plane_data.integral = np.delete(plane_data.integral, to_del)
-      plane_data.origin = np.delete(plane_data.origin, to_del, axis=0)
-      #print(plane_data.time.shape, plane_data.origin.shape)
-    return plane_data
-
-
-
-  def load_file_mp(self, h5in, procid):
-
-    #start = self.split_keys[procid].index('link1557')
-    #start = 0
-    #for a, k in enumerate(self.split_keys[procid][start:]):
-    for a, k in enumerate(self.split_keys[procid]):
-
-      events = [i for i in np.array(h5in[f'{k}/events/event_id'])]
-
-      if not a % 100:
-        with self.lock:
-          string = ''
-          self.split_count[procid] = a
-          for i in range(len(self.split_count)):
-            string += f'{self.split_count[i]}/{len(self.split_keys[i])} '
-          #print(f'{procid}: {a}/{len(self.split_keys[procid])}'), end='\r')
-          print(string, end='\r')
-          #print(string, end='\x1b[1K\r')
-
-      all_plane_datas = []
-      for eid in events:
-        all_plane_datas.append(self.get_plane_data(h5in, k, eid, 2))
-      #nhits = [i for i in np.array(h5in[f'{k}/events/nhits'][:])]
-      nhits = np.array(h5in[f'{k}/events/nhits'])
-      #print('nhits:', nhits)
-
-      with self.lock:
-        #print(len(events), len(all_plane_datas))
-        for i in range(len(events)):
-          #self.nhits.append(nhits[i])
-          self.events.append(events[i])
-        for plane_data in all_plane_datas:
-          self.plane2_time.append(plane_data.time)
-          self.nhits.append([0, 0, len(plane_data.time)])
-          self.plane2_wire.append(plane_data.wire)
-          self.plane2_integral.append(plane_data.integral)
-          self.plane2_origin.append(plane_data.origin)
-
-  def load_h5_mp(self, filename, num_workers):
-    with h5.File(filename, 'r') as h5in:
-      self.loaded_truth = False
-
-      ##Make lock and manager
-      ##And associated lists
-      with mp.Manager() as manager:
-        self.lock = mp.Lock()
-        self.events = manager.list() 
-        self.plane0_time = manager.list()
-        self.plane0_wire = manager.list()
-        self.plane0_integral = manager.list()
-        self.plane0_origin = manager.list()
-
-        self.plane1_time = manager.list()
-        self.plane1_wire = manager.list()
-        self.plane1_integral = manager.list()
-        self.plane1_origin = manager.list()
-
-        self.plane2_time = manager.list()
-        self.plane2_wire = manager.list()
-        self.plane2_integral = manager.list()
-        self.plane2_origin = manager.list()
-
-        self.keys = [k for k in h5in.keys()]
-        self.split_keys = manager.list([
-          self.keys[i::num_workers]
-          for i in range(num_workers)
-        ])
-
-        self.split_count = manager.list([0 for i in range(num_workers)])
-
-        self.nhits = manager.list() 
-
-        procs = [
-          mp.Process(target=self.load_file_mp,
-                     args=(h5in, i))
-          for i in range(num_workers)
-        ]
-
-        for p in procs:
-          p.start()
-        for p in procs:
-          p.join()
-
-        self.plane0_time = list(self.plane0_time)
-        self.plane0_wire = list(self.plane0_wire)
-        self.plane0_integral = list(self.plane0_integral)
-        self.plane0_origin = list(self.plane0_origin)
-
-        self.plane1_time = list(self.plane1_time) 
-        self.plane1_wire = list(self.plane1_wire)
-        self.plane1_integral = list(self.plane1_integral)
-        self.plane1_origin = list(self.plane1_origin)
-
-        self.plane2_time = list(self.plane2_time) 
-        self.plane2_wire = list(self.plane2_wire)
-        self.plane2_integral = list(self.plane2_integral)
-        self.plane2_origin = list(self.plane2_origin)
-
-        self.wires = [self.plane0_wire, self.plane1_wire, self.plane2_wire]
-        self.times = [self.plane0_time, self.plane1_time, self.plane2_time]
-        self.integrals = [self.plane0_integral, self.plane1_integral, self.plane2_integral]
-        self.origins = [self.plane0_origin, self.plane1_origin, self.plane2_origin]
-        self.nhits = np.array(self.nhits)
-
-        self.nevents = len(self.nhits)
-        self.events = np.array(self.events)
-
+    hits = h5in[f'{k}/plane_{pid}_hits']
+    rows = get_event_rows(h5in, k, eid, pid)
+    store = self.build_plane_data(
+      np.zeros(len(rows), dtype=int),
+      read_rows(hits['wire'], rows),
+      read_rows(hits['time'], rows),
+      read_rows(hits['integral'], rows),
+      read_rows(hits['origin'], rows),
+    )
+    coords = store.get(0, 'coords')
+    return PlaneData(coords[:, 0], coords[:, 1],
+                     store.get(0, 'integral'), get_origins(store, 0))
+
+  def get_link_data(self, h5in, k, pid, events=None):
+    ##Reads the plane's hit table once, encodes and merges the hits of
+    ##every event in the link (or only those in events) together.
+    ##Returns a PlaneStore of the link
+    if events is None: events = np.array(h5in[f'{k}/events/event_id'])
+    hits = h5in[f'{k}/plane_{pid}_hits']
+    hit_events = stats.read(hits['event_id'])
+    with stats.stage('match'):
+      rows, lengths = match_hits(events, hit_events)
+      event_index = np.repeat(np.arange(len(events)), lengths)
+    stats.count(hits=len(rows))
+
+    return self.build_plane_data(
+      event_index,
+      read_rows(hits['wire'], rows),
+      read_rows(hits['time'], rows),
+      read_rows(hits['integral'], rows),
+      read_rows(hits['origin'], rows),
+      nevents=len(events),
+    )
+
+  def build_plane_data(self, event_index, wire, time, integral, raw_origin,
+                       nevents=1):
+    ##event_index must be non-decreasing
+    with stats.stage('encode'):
+      wire = wire.astype(int)
+      time = (912 - (time - 500.)/6.025).astype(int)
+      origins = encode_origins(raw_origin, self.nfeatures)
+
+      if self.nfeatures < 3:
+        ##Drop noise hits
+        keep = np.sum(origins, axis=1) != 0.
+        event_index, wire, time = event_index[keep], wire[keep], time[keep]
+        integral, origins = integral[keep], origins[keep]
+
+    with stats.stage('merge'):
+      keep, integral, origins = merge_duplicates(
+          event_index, wire, time, integral, origins)
+
+    with stats.stage('build'):
+      coords = np.zeros((len(keep), 2), dtype=self.dtypes['coords'])
+      coords[:, 0] = cast_coords(wire[keep], self.dtypes['coords'])
+      coords[:, 1] = cast_coords(time[keep], self.dtypes['coords'])
+      columns = {
+        'coords': coords,
+        'integral': integral.astype(self.dtypes['integral'], copy=False),
+        **origin_columns(origins, self.dtypes['origin']),
+      }
+      lengths = np.bincount(event_index[keep], minlength=nevents)
+    return PlaneStore.from_lengths(columns, lengths)
+
+  def load_link(self, h5in, k, rows=None, pids=[2]):
+    ##Everything kept from one link, as numpy arrays.
+    ##rows restricts it to those events of the link
+    events = stats.read(h5in[f'{k}/events/event_id'])
+    if rows is not None: events = events[rows]
+    stats.count(links=1, events=len(events))
+    planes = [None, None, None]
+    for pid in pids:
+      planes[pid] = self.get_link_data(h5in, k, pid, events)
+    return {
+      'events': events,
+      'link_row': np.arange(len(events)) if rows is None else np.asarray(rows),
+      'planes': planes,
+    }
+
+  def set_link_results(self, link_results):
+    ##Joins the load_link results, in order, into this PDSPData
+    self.events = np.concatenate([r['events'] for r in link_results])
+    self.link_row = np.concatenate([r['link_row'] for r in link_results])
+    self.link_index = np.repeat(np.arange(len(link_results)),
+                                [len(r['events']) for r in link_results])
+    self.event_key = event_keys(self.events)
+    self.nevents = len(self.events)
+
+    self.planes = [None, None, None]
+    self.nhits = np.zeros((self.nevents, 3), dtype=int)
+    self.set_planes(link_results, [
+      p for p in range(3) if link_results[0]['planes'][p] is not None])
+
+  def set_planes(self, link_results, pids):
+    ##PDSPBase.set_planes; nhits counts the hits kept after dropping noise
+    ##and merging duplicates
+    super().set_planes(link_results, pids)
+    for pid in pids:
+      self.nhits[:, pid] = self.planes[pid].lengths()
+
+  def cache_params(self):
+    return {'type': 'process_all_hits', 'maxtime': self.maxtime,
+            'nfeatures': self.nfeatures}
 
   def get_plane(self, eventindex, pid):
     #check eventindex
@@ -225,15 +184,16 @@ class PDSPData:
       ##TODO -- throw exception
       return 0
 
-    #nhits = self.nhits[eventindex, pid]
-    locations = np.zeros((len(self.wires[pid][eventindex]), 2), dtype=int)
-    locations[:, 0] = self.wires[pid][eventindex]
-    locations[:, 1] = self.times[pid][eventindex]
-    #locations[:, 2] = np.arange(nhits)
+    if self.planes[pid] is None: self.load_planes([pid])
+    if self.planes[pid] is None:
+      raise ValueError(f'Plane {pid} was not loaded')
 
-    features = np.array([[i] for i in self.integrals[pid][eventindex]])
-    origins = np.array([i for i in self.origins[pid][eventindex]])
-    return (locations, features), origins
+    ##Views into the plane's store, in its storage dtypes. Packed
+    ##origins are unpacked into new (cosmic, beam[, noise]) rows
+    plane = self.planes[pid]
+    locations = plane.get(eventindex, 'coords')
+    features = plane.get(eventindex, 'integral').reshape(-1, 1)
+    return (locations, features), get_origins(plane, eventindex)
 
 
     
@@ -291,61 +251,21 @@ class PDSPData:
 
 
   def clean_events(self, check_nhits=True):
-  ##Check this -- not working
-    pass
-    #nohits = np.any(self.nhits == 0, axis=1)
-    #print(len(nohits))
-    #indices = np.where(
-    #  (nohits if check_nhits else check_nhits)
-    #)
-
-    ##self.pdg = np.delete(self.pdg, indices)
-    ##self.topos = np.delete(self.topos, indices)
-    ##self.interacted = np.delete(self.interacted, indices)
-    ##self.n_neutron = np.delete(self.n_neutron, indices)
-    ##self.n_proton = np.delete(self.n_proton, indices)
-    ##self.n_piplus = np.delete(self.n_piplus, indices)
-    ##self.n_piminus = np.delete(self.n_piminus, indices)
-    ##self.n_pi0 = np.delete(self.n_pi0, indices)
-    #self.events = np.delete(self.events, indices)
-
-    ##self.events = np.delete(self.events, indices, axis=0)
-    #self.nhits = np.delete(self.nhits, indices, axis=0)
-    ##self.event_keys = np.delete(self.event_keys, indices)
-    #self.nevents -= len(indices[0])
-
-    #for i in indices[0][::-1]:
-    #  #print('Deleting', i)
-    #  self.delete_event(i)
-
-  def delete_event(self, i):
-    #del self.plane0_time[i]
-    #del self.plane0_wire[i]
-    #del self.plane0_integral[i]
-
-    #del self.plane1_time[i]
-    #del self.plane1_wire[i]
-    #del self.plane1_integral[i]
-
-    del self.plane2_time[i]
-    del self.plane2_wire[i]
-    del self.plane2_integral[i]
-    del self.plane2_origin[i]
+    ##Drops events without hits on the loaded plane.
+    ##Returns the number of events each criterion hit
+    if check_nhits: self.load_planes([2])
+    criteria = clean_criteria(self.nhits, [2], check_nhits=check_nhits)
+    select_events(self, report_criteria(criteria, self.nevents))
+    return {n: int(np.count_nonzero(c)) for n, c in criteria.items()}
 
   def get_nbatches(self, batchsize=2):
     return ceil(self.nevents/batchsize)
 
   def get_sample_weights(self, pid=2):
-
-    cosmic = 0
-    beam = 0
-    noise = 0
-    nhits = 0
-    for i in range(len(self.origins[2])):
-      cosmic += np.sum(self.origins[2][i].argmax(1) == 0)
-      beam += np.sum(self.origins[2][i].argmax(1) == 1)
-      nhits += len(self.origins[2][i])
-      noise += np.sum(self.origins[2][i].argmax(1) == 2)
+    self.load_planes([2])
+    classes, _ = hit_classes(self.planes[2])
+    nhits = len(classes)
+    cosmic, beam, noise = np.bincount(classes, minlength=3)[:3]
 
     #total_nhits = len([origins for origins in self.origins[pid]])
     #total_origins = np.sum(np.array([np.sum(origins, axis=0) for origins in self.origins[pid]]), axis=0)
@@ -2,6 +2,14 @@ import numpy as np
 from math import ceil, sqrt, exp, pi
 import h5py as h5
 import multiprocessing as mp
+import zlib
+from collections import OrderedDict
+from hit_store import (PlaneStore, clean_criteria, report_criteria,
+                       select_events, pack_event_ids, event_keys,
+                       find_event,
+                       locate_event, storage_dtypes, cast_coords)
+import pdsp_cache
+from ingest_stats import stats, IngestLog
 
 class PlaneData:
   def __init__(self, wire, time, integral):
@@ -9,26 +17,378 @@ class PlaneData:
     self.time = time
     self.integral = integral
 
-class PDSPData:
-  def __init__(self, maxtime=913, linked=True, maxwires=[800, 800, 480]):
+def group_hits(events, hit_events):
+  ##Match each hit to its row in events in one pass.
+  ##Returns the hit indices laid out event by event (in the order of events)
+  ##and the number of hits of each event
+  events = np.asarray(events).reshape(len(events), -1)
+  hit_events = np.asarray(hit_events).reshape(len(hit_events), -1)
+  _, codes = np.unique(np.concatenate([events, hit_events]),
+                       axis=0, return_inverse=True)
+  codes = codes.reshape(-1)
+  event_codes = codes[:len(events)]
+  hit_codes = codes[len(events):]
+
+  ##Stable so hits keep their file order within each event
+  order = np.argsort(hit_codes, kind='stable')
+  sorted_codes = hit_codes[order]
+  starts = np.searchsorted(sorted_codes, event_codes, side='left')
+  lengths = np.searchsorted(sorted_codes, event_codes, side='right') - starts
+
+  offsets = np.cumsum(lengths) - lengths
+  rows = order[np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())]
+  return rows, lengths
+
+def hit_ranges(hit_events):
+  ##For a hit table grouped by event (the hits of each event contiguous,
+  ##events in any order): the packed key, start and end row of every event
+  ##in it, sorted by key. None if the table is not grouped
+  keys = pack_event_ids(hit_events)
+  bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+  starts = np.concatenate([[0], bounds]).astype(np.int64)
+  ends = np.concatenate([bounds, [len(keys)]]).astype(np.int64)
+  if len(keys) == 0: starts = ends = starts[:0]
+  run_keys = keys[starts]
+
+  if np.any(run_keys[1:] < run_keys[:-1]):
+    order = np.argsort(run_keys, kind='stable')
+    run_keys, starts, ends = run_keys[order], starts[order], ends[order]
+  ##An event appearing in two separate runs of rows
+  if np.any(run_keys[1:] == run_keys[:-1]): return None
+  return run_keys, starts, ends
+
+def find_ranges(ranges, events):
+  ##[start, end) hit rows of each of events by binary search in ranges
+  ##(see hit_ranges). Events without hits get an empty range
+  keys, starts, ends = ranges
+  wanted = pack_event_ids(events)
+  if len(keys) == 0:
+    empty = np.zeros(len(wanted), dtype=np.int64)
+    return empty, empty
+  pos = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+  found = keys[pos] == wanted
+  return np.where(found, starts[pos], 0), np.where(found, ends[pos], 0)
+
+def match_hits(events, hit_events):
+  ##Same as group_hits, by binary search when the hits are grouped by
+  ##event (as written). Falls back to group_hits otherwise, or when some
+  ##id does not fit in a packed key
+  try:
+    ranges = hit_ranges(hit_events)
+    if ranges is not None: starts, ends = find_ranges(ranges, events)
+  except ValueError:
+    ranges = None
+  if ranges is None: return group_hits(events, hit_events)
+
+  lengths = ends - starts
+  offsets = np.cumsum(lengths) - lengths
+  rows = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+  return rows, lengths
+
+##hit_ranges of the last HIT_RANGE_CACHE_SIZE hit tables read one event at
+##a time in this process, by (file, file ident, link, plane), so that only
+##the first read of a table scans it. A rewritten file has a new ident
+HIT_RANGE_CACHE_SIZE = 64
+hit_range_cache = OrderedDict()
+
+def get_event_rows(h5in, k, eid, pid):
+  ##Hit rows of event eid in a plane's hit table
+  ident = pdsp_cache.file_ident(h5in.filename)
+  key = (h5in.filename, ident['size'], ident['mtime'], k, pid)
+  if key in hit_range_cache:
+    hit_range_cache.move_to_end(key)
+  else:
+    try:
+      hit_range_cache[key] = hit_ranges(
+          stats.read(h5in[f'{k}/plane_{pid}_hits/event_id']))
+    except ValueError:
+      hit_range_cache[key] = None
+    while len(hit_range_cache) > HIT_RANGE_CACHE_SIZE:
+      hit_range_cache.popitem(last=False)
+
+  ranges = hit_range_cache[key]
+  if ranges is not None and event_keys(eid) is not None:
+    (start,), (end,) = find_ranges(ranges, [eid])
+    return np.arange(start, end)
+  hit_events = np.array(h5in[f'{k}/plane_{pid}_hits/event_id'][:])
+  return np.flatnonzero(np.all(hit_events == eid, axis=1))
+
+def read_rows(dataset, rows):
+  ##dataset[rows], flattened, reading only the hyperslab that spans rows
+  if len(rows) == 0: return np.asarray(dataset[0:0]).flatten()
+  low, high = int(rows.min()), int(rows.max()) + 1
+  return stats.read(dataset, np.s_[low:high]).flatten()[rows - low]
+
+TRUTH_NAMES = ['pdg', 'interacted', 'n_neutron', 'n_proton',
+               'n_piplus', 'n_piminus', 'n_pi0']
+
+def read_truth(group):
+  ##Reads every truth dataset of group (a link, or the whole file when
+  ##unlinked) in one go, flattened to one entry per event
+  return {n: stats.read(group[f'truth/{n}']).reshape(-1) for n in TRUTH_NAMES}
+
+def get_topos(pdg, interacted, n_piplus, n_piminus, n_pi0):
+  ##Topology code of each event:
+  ## -1 -- not a beam pi+/mu+
+  ##  3 -- did not interact
+  ##  0 -- no pions in the final state
+  ##  1 -- a single pi0 and no charged pions
+  ##  2 -- anything else
+  no_charged = (n_piplus == 0) & (n_piminus == 0)
+  return np.select(
+    [~np.isin(pdg, [211, -13]),
+     ~np.asarray(interacted, dtype=bool),
+     no_charged & (n_pi0 == 0),
+     no_charged & (n_pi0 == 1)],
+    [-1, 3, 0, 1], default=2)
+
+class Selection:
+  ##Which events to ingest. Decided from events/nhits and truth/* alone,
+  ##before any hit table is read.
+  ##  topos         -- topology codes to keep (see get_topos)
+  ##  pdg           -- beam pdg codes to keep
+  ##  nhits         -- {plane: (min, max)} allowed hit counts, max may be None
+  ##  link_fraction -- fraction of the links to read, picked by a hash of
+  ##                   the link name so the same links come back every time
+  ##  max_events    -- stop after this many events (in file order)
+  def __init__(self, topos=None, pdg=None, nhits={}, link_fraction=1.,
+               max_events=-1):
+    self.topos = topos
+    self.pdg = pdg
+    self.nhits = nhits
+    self.link_fraction = link_fraction
+    self.max_events = max_events
+
+  def params(self):
+    ##Plain description of the selection, used in cache keys
+    return {
+      'topos': None if self.topos is None else sorted(self.topos),
+      'pdg': None if self.pdg is None else sorted(self.pdg),
+      'nhits': {str(p): list(r) for p, r in sorted(self.nhits.items())},
+      'link_fraction': self.link_fraction,
+      'max_events': self.max_events,
+    }
+
+  def use_link(self, k):
+    if self.link_fraction >= 1.: return True
+    return zlib.crc32(k.encode())/2**32 < self.link_fraction
+
+  def event_mask(self, group):
+    nhits = np.array(group['events/nhits'])
+    keep = np.ones(len(nhits), dtype=bool)
+    for pid, (low, high) in self.nhits.items():
+      keep &= nhits[:, pid] >= low
+      if high is not None: keep &= nhits[:, pid] <= high
+
+    if self.topos is not None or self.pdg is not None:
+      truth = read_truth(group)
+      if self.pdg is not None:
+        keep &= np.isin(truth['pdg'], self.pdg)
+      if self.topos is not None:
+        topos = get_topos(truth['pdg'], truth['interacted'], truth['n_piplus'],
+                          truth['n_piminus'], truth['n_pi0'])
+        keep &= np.isin(topos, self.topos)
+    return keep, nhits
+
+  def links(self, h5in, keys):
+    ##Yields (link, rows, nhits) for every link with selected events.
+    ##rows are the selected event rows of the link (None for all of them)
+    ##and nhits is events/nhits of the whole link
+    nselected = 0
+    for k in keys:
+      if self.max_events >= 0 and nselected >= self.max_events: break
+      if not self.use_link(k): continue
+
+      keep, nhits = self.event_mask(h5in[k])
+      rows = np.flatnonzero(keep)
+      if self.max_events >= 0: rows = rows[:self.max_events - nselected]
+      if len(rows) == 0: continue
+
+      nselected += len(rows)
+      yield k, (None if len(rows) == len(keep) else rows), nhits
+
+  def plan(self, h5in, keys):
+    ##Returns (link, rows, nhits) for every link with selected events,
+    ##as links() but with nhits the total hit count of the rows
+    return [(k, rows, int(np.sum(nhits if rows is None else nhits[rows])))
+            for k, rows, nhits in self.links(h5in, keys)]
+
+##Per-process state of the load_links pool
+worker_state = {}
+
+def init_worker(pdsp_data, filename, kwargs):
+  worker_state['pdsp_data'] = pdsp_data
+  worker_state['h5in'] = h5.File(filename, 'r')
+  worker_state['kwargs'] = kwargs
+
+def run_link(job):
+  i, k, rows = job
+  result = worker_state['pdsp_data'].load_link(
+      worker_state['h5in'], k, rows, **worker_state['kwargs'])
+  return i, result, stats.take()
+
+def load_links(pdsp_data, filename, plan, num_workers, log=None, **kwargs):
+  ##Runs pdsp_data.load_link over the links of plan (see Selection.plan)
+  ##in a pool of num_workers processes, each with its own handle on
+  ##filename. Links are handed out one at a time from a shared queue,
+  ##largest first, so no worker sits idle while another is stuck on a long
+  ##tail. Results come back in bulk, one per link, and are returned in the
+  ##order of plan whichever worker ran them. kwargs go to every load_link;
+  ##the workers' stats of each link go to log (an IngestLog)
+  sizes = np.array([size for _, _, size in plan])
+  jobs = [(i, plan[i][0], plan[i][1])
+          for i in np.argsort(-sizes, kind='stable')]
+
+  results = [None]*len(plan)
+  with mp.Pool(num_workers, initializer=init_worker,
+               initargs=(pdsp_data, filename, kwargs)) as pool:
+    for a, (i, r, record) in enumerate(pool.imap_unordered(run_link, jobs)):
+      if not a % 100: print(f'{a}/{len(plan)}', end='\r')
+      results[i] = r
+      if log is not None: log.add(record)
+  return results
+
+def run_plan(pdsp_data, filename, plan, num_workers=0, **kwargs):
+  ##load_links, or the same in this process when num_workers is 0.
+  ##Daemonic processes (e.g. DataLoader workers) cannot start a pool,
+  ##so they always read sequentially.
+  ##Ends with a throughput summary, also written as JSON lines to
+  ##pdsp_data.stats_file if set (see ingest_stats)
+  log = IngestLog(getattr(pdsp_data, 'stats_file', None))
+  ##Reads done so far (planning the selection) count as this process's
+  log.add(stats.take())
+  if num_workers > 0 and not mp.current_process().daemon:
+    results = load_links(pdsp_data, filename, plan, num_workers, log,
+                         **kwargs)
+  else:
+    results = []
+    with h5.File(filename, 'r') as h5in:
+      for a, (k, rows, _) in enumerate(plan):
+        if not a % 100: print(f'{a}/{len(plan)}', end='\r')
+        results.append(pdsp_data.load_link(h5in, k, rows, **kwargs))
+        log.add(stats.take())
+  log.summary()
+  return results
+
+def source_plan(pdsp_data):
+  ##Plan (see Selection.plan) that reads back exactly the current events
+  ##of pdsp_data, in order, from their link_index/link_row
+  links, starts = np.unique(pdsp_data.link_index, return_index=True)
+  ends = np.append(starts[1:], len(pdsp_data.link_index))
+  return [(pdsp_data.keys[l], pdsp_data.link_row[s:e], e - s)
+          for l, s, e in zip(links, starts, ends)]
+
+class PDSPBase:
+  ##Loading, lazy planes and event lookup shared by the PDSPData of
+  ##process_hits and process_all_hits. Those provide load_link and
+  ##set_link_results (see run_plan) and cache_params, the ingest
+  ##parameters their caches are keyed by (see pdsp_cache)
+
+  def find_event(self, eid):
+    ##Index of the event with id eid (run, subrun, event), -1 if not loaded
+    return find_event(self, eid)
+
+  def locate_event(self, i):
+    ##Link, position in the link and hit rows per plane of event i
+    return locate_event(self, i)
+
+  def get_plan(self, filename, selection=None, keys=None):
+    ##Selection.plan of filename; keys restricts it to those links
+    if selection is None: selection = Selection()
+    with h5.File(filename, 'r') as h5in:
+      plan = selection.plan(h5in, [k for k in h5in.keys()
+                                   if keys is None or k in keys])
+    self.keys = [k for k, _, _ in plan]
+    return plan
+
+  def load_plan(self, filename, plan, num_workers, planes=[2], lazy=False):
+    ##Reads the links of plan. Only the hit tables of planes are read.
+    ##With lazy=True not even those -- each is read on its first get_plane
+    ##(see load_planes)
+    if len(plan) == 0:
+      raise ValueError('No events were selected')
+    self.source = (filename, num_workers)
+    self.lazy_planes = set(planes) if lazy else set()
+
+    ##Workers open their own handle and return each link's arrays
+    self.set_link_results(run_plan(self, filename, plan, num_workers,
+                                   pids=[] if lazy else list(planes)))
+
+  def load_h5_mp(self, filename, num_workers, selection=None, planes=[2],
+                 lazy=False, keys=None):
+    ##load_plan of the events selection picks; keys restricts the ingest
+    ##to those links
+    self.load_plan(filename, self.get_plan(filename, selection, keys),
+                   num_workers, planes, lazy)
+
+  def load_h5(self, filename, selection=None, planes=[2], lazy=False,
+              keys=None):
+    ##Same as load_h5_mp, in this process
+    self.load_h5_mp(filename, 0, selection, planes, lazy, keys)
+
+  def set_planes(self, link_results, pids):
+    ##Joins the given planes of the load_link results
+    for pid in pids:
+      self.planes[pid] = PlaneStore.concatenate(
+          [r['planes'][pid] for r in link_results])
+
+  def load_planes(self, pids):
+    ##Reads the lazily requested planes in pids that are not loaded yet,
+    ##for the events currently held (i.e. after any cleaning)
+    pids = [p for p in pids if self.planes[p] is None
+            and p in getattr(self, 'lazy_planes', set())]
+    if len(pids) == 0: return
+
+    filename, num_workers = self.source
+    self.set_planes(run_plan(self, filename, source_plan(self), num_workers,
+                             pids=pids), pids)
+    self.lazy_planes.difference_update(pids)
+
+  def load_cached(self, filename, cache_dir, num_workers=0, load=True,
+                  selection=None, planes=[2]):
+    ##Same as load_h5 (num_workers == 0) or load_h5_mp, but reuses the
+    ##preprocessed cache of filename in cache_dir when there is one.
+    ##Returns the cache path; load=False only makes sure the cache exists
+    params = {
+      **self.cache_params(),
+      'dtypes': self.dtypes,
+      'planes': sorted(planes),
+      'selection': None if selection is None else selection.params(),
+    }
+    def ingest(keys=None):
+      ##Number of events read. When refreshing (keys given), links without
+      ##selected events are no error: they just add none
+      plan = self.get_plan(filename, selection, keys)
+      if keys is not None and len(plan) == 0: return 0
+      self.load_plan(filename, plan, num_workers, planes)
+      return self.nevents
+    return pdsp_cache.load_or_ingest(
+      self, filename, cache_dir, ingest, params, load=load,
+      incremental=selection is None or selection.max_events < 0)
+
+class PDSPData(PDSPBase):
+  def __init__(self, maxtime=913, linked=True, maxwires=[800, 800, 480],
+               stats_file=None, dtypes=None):
     self.maxtime=maxtime
     self.maxwires=maxwires
     self.linked = linked
+    ##Storage dtypes of the hit columns (see hit_store.DTYPES)
+    self.dtypes = storage_dtypes(dtypes)
+    ##JSON lines of ingest throughput go here (see ingest_stats)
+    self.stats_file = stats_file
     self.tp = np.dtype([('integral', 'f4'),
                         ('rms', 'f4'), ('time', 'f4'), ('wire', 'f4')])
 
   def get_plane_data(self, h5in, k, eid, pid):
     ##To-Do: check maxtime and wires
-    #events = np.array(h5in[f'{k}/events/event_id'][:])
-    hit_events = np.array(h5in[f'{k}/plane_{pid}_hits/event_id'][:])
-    #print(hit_events)
-    #print(eid)
-    indices = np.all(hit_events == eid, axis=1)
-    #print(np.array(h5in[f'{k}/plane_{pid}_hits']['wire'])[indices].flatten().astype(int))
+    hits = h5in[f'{k}/plane_{pid}_hits']
+    rows = get_event_rows(h5in, k, eid, pid)
     plane_data = PlaneData(
-               np.array(h5in[f'{k}/plane_{pid}_hits']['wire'][:])[indices].flatten().astype(int),
-               (912 - (np.array(h5in[f'{k}/plane_{pid}_hits']['time'][:])[indices]- 500.)/6.025).flatten().astype(int),
-               np.array(h5in[f'{k}/plane_{pid}_hits']['integral'][:])[indices].flatten()
+               cast_coords(read_rows(hits['wire'], rows).astype(int),
+                           self.dtypes['coords']),
+               cast_coords((912 - (read_rows(hits['time'], rows) - 500.)/6.025).astype(int),
+                           self.dtypes['coords']),
+               read_rows(hits['integral'], rows).astype(self.dtypes['integral'])
            )
     #to_del = np.where((plane_data.time >= self.maxtime) |
     #                  (plane_data.wire >= self.maxwires[pid]))
@@ -41,233 +401,75 @@ class PDSPData:
     #plane_data.integral = np.delete(plane_data.integral, to_del)
     return plane_data
 
+  def get_link_data(self, h5in, k, pids=[0, 1, 2], events=None):
+    ##Reads each plane's hit table once and splits it into all events
+    ##of the link (or only those in events). Returns a PlaneStore per pid
+    if events is None: events = np.array(h5in[f'{k}/events/event_id'])
+    link_data = []
+    for pid in pids:
+      hits = h5in[f'{k}/plane_{pid}_hits']
+      hit_events = stats.read(hits['event_id'])
+      with stats.stage('match'):
+        rows, lengths = match_hits(events, hit_events)
+      wire = read_rows(hits['wire'], rows)
+      time = read_rows(hits['time'], rows)
+      integral = read_rows(hits['integral'], rows)
+
+      with stats.stage('encode'):
+        coords = np.zeros((len(rows), 2), dtype=int)
+        coords[:, 0] = wire
+        coords[:, 1] = 912 - (time - 500.)/6.025
+        coords = cast_coords(coords, self.dtypes['coords'])
+        integral = integral.astype(self.dtypes['integral'], copy=False)
+      link_data.append(PlaneStore.from_lengths(
+        {'coords': coords, 'integral': integral}, lengths))
+      stats.count(hits=len(rows))
+    return link_data
+
+
+  def load_link(self, h5in, k, rows=None, pids=[0, 1, 2]):
+    ##Everything kept from one link, as numpy arrays.
+    ##rows restricts it to those events of the link
+    events = stats.read(h5in[f'{k}/events/event_id'])
+    nhits = stats.read(h5in[f'{k}/events/nhits'])
+    truth = read_truth(h5in[k])
+    if rows is not None:
+      events, nhits = events[rows], nhits[rows]
+      truth = {n: t[rows] for n, t in truth.items()}
+    stats.count(links=1, events=len(events))
+
+    planes = [None, None, None]
+    for pid, store in zip(pids, self.get_link_data(h5in, k, pids, events)):
+      planes[pid] = store
+
+    with stats.stage('build'):
+      topos = get_topos(truth['pdg'], truth['interacted'], truth['n_piplus'],
+                        truth['n_piminus'], truth['n_pi0'])
+    return {
+      'events': events,
+      'link_row': np.arange(len(events)) if rows is None else np.asarray(rows),
+      'nhits': nhits,
+      **truth,
+      'topos': topos,
+      'planes': planes,
+    }
+
+  def set_link_results(self, link_results):
+    ##Joins the load_link results, in order, into this PDSPData
+    self.planes = [None, None, None]
+    self.set_planes(link_results, [
+      p for p in range(3) if link_results[0]['planes'][p] is not None])
+    for n in ['events', 'link_row', 'nhits'] + TRUTH_NAMES + ['topos']:
+      setattr(self, n, np.concatenate([r[n] for r in link_results]))
+    self.link_index = np.repeat(np.arange(len(link_results)),
+                                [len(r['events']) for r in link_results])
+    self.event_key = event_keys(self.events)
+    self.nevents = len(self.nhits)
+    self.loaded_truth = True
 
-  def load_file_mp(self, h5in, procid):
-    ### Getting truth
-    #pdg = [] 
-    #interacted = []
-    #n_neutron = []
-    #n_proton = []
-    #n_piplus = []
-    #n_piminus = []
-    #n_pi0 = []
-
-    for a, k in enumerate(self.split_keys[procid]):
-
-      events = [i for i in np.array(h5in[f'{k}/events/event_id'][:])]
-
-      if not a % 100:
-        with self.lock:
-          string = ''
-          self.split_count[procid] = a
-          for i in range(len(self.split_count)):
-            string += f'{self.split_count[i]}/{len(self.split_keys[i])} '
-          #print(f'{procid}: {a}/{len(self.split_keys[procid])}'), end='\r')
-          print(string, end='\r')
-          #print(string, end='\x1b[1K\r')
-
-      all_plane_datas = []
-      for eid in events:
-        all_plane_datas.append(
-          [self.get_plane_data(h5in, k, eid, i) for i in range(3)])
-      #nhits = [i for i in np.array(h5in[f'{k}/events/nhits'][:])]
-      nhits = np.array(h5in[f'{k}/events/nhits'])
-      #print('nhits:', nhits)
-
-      pdg = [i[0] for i in np.array(h5in[f'{k}/truth/pdg'])]
-      interacted = [i[0] for i in np.array(h5in[f'{k}/truth/interacted'])]
-      n_neutron = [i[0] for i in np.array(h5in[f'{k}/truth/n_neutron'])]
-      n_proton = [i[0] for i in np.array(h5in[f'{k}/truth/n_proton'])]
-      n_piplus = [i[0] for i in np.array(h5in[f'{k}/truth/n_piplus'])]
-      n_piminus = [i[0] for i in np.array(h5in[f'{k}/truth/n_piminus'])]
-      n_pi0 = [i[0] for i in np.array(h5in[f'{k}/truth/n_pi0'])]
-
-      topos = []
-      for i in range(len(pdg)):
-        if pdg[i] not in [211, -13]:
-          topos.append(-1)
-        elif not interacted[i]:
-          topos.append(3)
-        elif (n_piplus[i] == 0 and n_piminus[i] == 0 and
-              n_pi0[i] == 0):
-          topos.append(0)
-        elif (n_piplus[i] == 0 and n_piminus[i] == 0 and
-              n_pi0[i] == 1):
-          topos.append(1)
-        else:
-          topos.append(2)
-      #print(f'Added {len(sub_pdg)} truths from {k}')
-
-      with self.lock:
-        #print(len(nhits), len(pdg), len(all_plane_datas), len(events))
-        for plane_data in all_plane_datas:
-          self.plane2_time.append(plane_data[2].time)
-          self.plane2_wire.append(plane_data[2].wire)
-          self.plane2_integral.append(plane_data[2].integral)
-
-          self.plane1_time.append(plane_data[1].time)
-          self.plane1_wire.append(plane_data[1].wire)
-          self.plane1_integral.append(plane_data[1].integral)
-
-          self.plane0_time.append(plane_data[0].time)
-          self.plane0_wire.append(plane_data[0].wire)
-          self.plane0_integral.append(plane_data[0].integral)
-        #for eid in events: self.events.append(eid)
-        #for n in nhits: self.nhits.append(n)
-        for i in range(len(pdg)):
-          self.nhits.append(nhits[i])
-          self.events.append(events[i])
-          self.pdg.append(pdg[i])
-          self.interacted.append(interacted[i])
-          self.n_neutron.append(n_neutron[i])
-          self.n_proton.append(n_proton[i])
-          self.n_piplus.append(n_piplus[i])
-          self.n_piminus.append(n_piminus[i])
-          self.n_pi0.append(n_pi0[i])
-          self.topos.append(topos[i])
-
-  def load_h5_mp(self, filename, num_workers):
-    with h5.File(filename, 'r') as h5in:
-      self.loaded_truth = False
-
-      ##Make lock and manager
-      ##And associated lists
-      with mp.Manager() as manager:
-        self.lock = mp.Lock()
-        self.events = manager.list() 
-        self.plane0_time = manager.list()
-        self.plane0_wire = manager.list()
-        self.plane0_integral = manager.list()
-
-        self.plane1_time = manager.list()
-        self.plane1_wire = manager.list()
-        self.plane1_integral = manager.list()
-
-        self.plane2_time = manager.list()
-        self.plane2_wire = manager.list()
-        self.plane2_integral = manager.list()
-
-        self.pdg = manager.list()
-        self.interacted = manager.list()
-        self.n_proton = manager.list()
-        self.n_neutron = manager.list()
-        self.n_piplus = manager.list()
-        self.n_piminus = manager.list()
-        self.n_pi0 = manager.list()
-        self.topos = manager.list()
-
-
-        self.keys = [k for k in h5in.keys()]
-        self.split_keys = manager.list([
-          self.keys[i::num_workers]
-          for i in range(num_workers)
-        ])
-
-        self.split_count = manager.list([0 for i in range(num_workers)])
-
-        self.nhits = manager.list() 
-
-        procs = [
-          mp.Process(target=self.load_file_mp,
-                     args=(h5in, i))
-          for i in range(num_workers)
-        ]
-
-        for p in procs:
-          p.start()
-        for p in procs:
-          p.join()
-
-        self.plane0_time = list(self.plane0_time) 
-        self.plane0_wire = list(self.plane0_wire)
-        self.plane0_integral = list(self.plane0_integral)
-
-        self.plane1_time = list(self.plane1_time) 
-        self.plane1_wire = list(self.plane1_wire)
-        self.plane1_integral = list(self.plane1_integral)
-
-        self.plane2_time = list(self.plane2_time) 
-        self.plane2_wire = list(self.plane2_wire)
-        self.plane2_integral = list(self.plane2_integral)
-
-        self.wires = [self.plane0_wire, self.plane1_wire, self.plane2_wire]
-        self.times = [self.plane0_time, self.plane1_time, self.plane2_time]
-        self.integrals = [self.plane0_integral, self.plane1_integral, self.plane2_integral]
-        self.nhits = np.array(self.nhits)
-
-        self.nevents = len(self.nhits)
-        self.events = np.array(self.events)
-
-        print(f'Loading truth')
-        self.pdg = np.array(self.pdg)
-        self.interacted = np.array(self.interacted)
-        self.n_proton = np.array(self.n_proton)
-        self.n_neutron = np.array(self.n_neutron)
-        self.n_piplus = np.array(self.n_piplus)
-        self.n_piminus = np.array(self.n_piminus)
-        self.n_pi0 = np.array(self.n_pi0)
-        self.topos = np.array(self.topos)
-
-        #self.load_truth(h5in)
-
-
-  def load_h5(self, filename):
-    with h5.File(filename, 'r') as h5in:
-
-      self.loaded_truth = False
-      self.plane0_time = []
-      self.plane0_wire = []
-      self.plane0_integral = []
-
-      self.plane1_time = []
-      self.plane1_wire = []
-      self.plane1_integral = []
-
-      self.plane2_time = []
-      self.plane2_wire = []
-      self.plane2_integral = []
-
-      self.keys = [k for k in h5in.keys()]
-      nhits = []
-
-      self.events = []
-      for a, k in enumerate(self.keys):
-        nhits += [i for i in np.array(h5in[f'{k}/events/nhits'][:])]
-
-        temp_events = [i for i in np.array(h5in[f'{k}/events/event_id'][:])]
-        self.events += temp_events
-
-        if not a % 100: print(f'{a}/{len(self.keys)}', end='\r')
-        for eid in temp_events:
-          #plane_data = self.get_plane_data(h5in, k, eid, 0)
-          #self.plane0_time.append(plane_data.time)
-          #self.plane0_wire.append(plane_data.wire)
-          #self.plane0_integral.append(plane_data.integral)
-
-          #plane_data = self.get_plane_data(h5in, k, eid, 1)
-          #self.plane1_time.append(plane_data.time)
-          #self.plane1_wire.append(plane_data.wire)
-          #self.plane1_integral.append(plane_data.integral)
-
-          plane_data = self.get_plane_data(h5in, k, eid, 2)
-          self.plane2_time.append(plane_data.time)
-          self.plane2_wire.append(plane_data.wire)
-          self.plane2_integral.append(plane_data.integral)
-
-      self.wires = [self.plane0_wire, self.plane1_wire, self.plane2_wire]
-      self.times = [self.plane0_time, self.plane1_time, self.plane2_time]
-      self.integrals = [self.plane0_integral, self.plane1_integral, self.plane2_integral]
-      self.nhits = np.array(nhits)
-      self.events = np.array(self.events)
-
-      self.nevents = len(self.nhits)
-
-      print(f'Loading truth')
-      self.load_truth(h5in)
-      #self.clean_events()
-      #print('getting event')
-      #if self.nevents > 0:
-      #  self.get_event(0)
+  def cache_params(self):
+    return {'type': 'process_hits', 'maxtime': self.maxtime,
+            'linked': self.linked}
 
   def get_indices(self, pdg):
     return [i for i in range(len(self.pdg)) if self.pdg[i][0] == pdg]
@@ -278,84 +480,19 @@ class PDSPData:
       return
     self.loaded_truth = True
     if not self.linked:
-      if 'truth' in h5in.keys():
-        found_truth = True
-        self.pdg = np.array(h5in['truth']['pdg'][:]) 
-        self.interacted = np.array(h5in['truth']['interacted'][:])
-        self.n_neutron = np.array(h5in['truth']['n_neutron'][:])
-        self.n_proton = np.array(h5in['truth']['n_proton'][:])
-        self.n_piplus = np.array(h5in['truth']['n_piplus'][:])
-        self.n_piminus = np.array(h5in['truth']['n_piminus'][:])
-        self.n_pi0 = np.array(h5in['truth']['n_pi0'][:])
-
-        self.pdg = np.ndarray.flatten(self.pdg)
-        self.interacted = np.ndarray.flatten(self.interacted)
-        self.n_neutron = np.ndarray.flatten(self.n_neutron)
-        self.n_proton = np.ndarray.flatten(self.n_proton)
-        self.n_piplus = np.ndarray.flatten(self.n_piplus)
-        self.n_piminus = np.ndarray.flatten(self.n_piminus)
-        self.n_pi0 = np.ndarray.flatten(self.n_pi0)
-
+      groups = [h5in] if 'truth' in h5in.keys() else []
     else:
-      found_truth = False 
-      pdg = [] 
-      interacted = []
-      n_neutron = []
-      n_proton = []
-      n_piplus = []
-      n_piminus = []
-      n_pi0 = []
-      for k in self.keys:
-        if 'truth' in h5in[f'{k}'].keys():
-          found_truth = True
-
-          sub_pdg = [i for i in np.array(h5in[f'{k}/truth/pdg'][:])]
-
-          pdg += sub_pdg
-          interacted += [i for i in np.array(h5in[f'{k}/truth/interacted'][:])]
-          n_neutron += [i for i in np.array(h5in[f'{k}/truth/n_neutron'][:])]
-          n_proton += [i for i in np.array(h5in[f'{k}/truth/n_proton'][:])]
-          n_piplus += [i for i in np.array(h5in[f'{k}/truth/n_piplus'][:])]
-          n_piminus += [i for i in np.array(h5in[f'{k}/truth/n_piminus'][:])]
-          n_pi0 += [i for i in np.array(h5in[f'{k}/truth/n_pi0'][:])]
-
-          #print(f'Added {len(sub_pdg)} truths from {k}')
-
-      if found_truth:
-        self.pdg = np.array(pdg)
-        self.interacted = np.array(interacted)
-        self.n_proton = np.array(n_proton)
-        self.n_neutron = np.array(n_neutron)
-        self.n_piplus = np.array(n_piplus)
-        self.n_piminus = np.array(n_piminus)
-        self.n_pi0 = np.array(n_pi0)
-
-        self.pdg = np.ndarray.flatten(self.pdg)
-        self.interacted = np.ndarray.flatten(self.interacted)
-        self.n_neutron = np.ndarray.flatten(self.n_neutron)
-        self.n_proton = np.ndarray.flatten(self.n_proton)
-        self.n_piplus = np.ndarray.flatten(self.n_piplus)
-        self.n_piminus = np.ndarray.flatten(self.n_piminus)
-        self.n_pi0 = np.ndarray.flatten(self.n_pi0)
-
-    if found_truth: self.get_truth_topos()
+      groups = [h5in[k] for k in self.keys if 'truth' in h5in[k].keys()]
+
+    if len(groups) == 0: return
+    truths = [read_truth(g) for g in groups]
+    for n in TRUTH_NAMES:
+      setattr(self, n, np.concatenate([t[n] for t in truths]))
+    self.get_truth_topos()
 
   def get_truth_topos(self):
-    topos = []
-    for i in range(len(self.pdg)):
-      if self.pdg[i] not in [211, -13]:
-        topos.append(-1)
-      elif not self.interacted[i]:
-        topos.append(3)
-      elif (self.n_piplus[i] == 0 and self.n_piminus[i] == 0 and
-            self.n_pi0[i] == 0):
-        topos.append(0)
-      elif (self.n_piplus[i] == 0 and self.n_piminus[i] == 0 and
-            self.n_pi0[i] == 1):
-        topos.append(1)
-      else:
-        topos.append(2)
-    self.topos = np.array(topos)
+    self.topos = get_topos(self.pdg, self.interacted, self.n_piplus,
+                           self.n_piminus, self.n_pi0)
 
   def load_data(self, pid, eventindex):  #TODO remove
 
@@ -380,13 +517,14 @@ class PDSPData:
       ##TODO -- throw exception
       return 0
 
-    nhits = self.nhits[eventindex, pid]
-    locations = np.zeros((nhits, 2), dtype=int)
-    locations[:, 0] = self.wires[pid][eventindex]
-    locations[:, 1] = self.times[pid][eventindex]
-    #locations[:, 2] = np.arange(nhits)
+    if self.planes[pid] is None: self.load_planes([pid])
+    if self.planes[pid] is None:
+      raise ValueError(f'Plane {pid} was not loaded')
 
-    features = np.array([[i] for i in self.integrals[pid][eventindex]])
+    ##Views into the plane's store -- no copies
+    plane = self.planes[pid]
+    locations = plane.get(eventindex, 'coords')
+    features = plane.get(eventindex, 'integral').reshape(-1, 1)
     return (locations, features)
 
 
@@ -401,56 +539,19 @@ class PDSPData:
       return 0
 
 
-    wires = self.wires[pid][eventindex]
-    times = self.times[pid][eventindex]
-
-    for i in range(len(wires)):
-      plane[wires[i], times[i]] = self.integrals[pid][eventindex][i]
+    coords = self.planes[pid].get(eventindex, 'coords')
+    plane[coords[:, 0], coords[:, 1]] = self.planes[pid].get(eventindex, 'integral')
 
 
     return plane
 
 
   def clean_events(self, check_nhits=True):
-  ##Check this -- not working
-    nohits = np.any(self.nhits == 0, axis=1)
-    print(len(nohits))
-    indices = np.where(
-      ((self.pdg != 211) & (self.pdg != -13)) |
-      (nohits if check_nhits else check_nhits)
-    )
-
-    self.pdg = np.delete(self.pdg, indices)
-    self.topos = np.delete(self.topos, indices)
-    self.interacted = np.delete(self.interacted, indices)
-    self.n_neutron = np.delete(self.n_neutron, indices)
-    self.n_proton = np.delete(self.n_proton, indices)
-    self.n_piplus = np.delete(self.n_piplus, indices)
-    self.n_piminus = np.delete(self.n_piminus, indices)
-    self.n_pi0 = np.delete(self.n_pi0, indices)
-    self.events = np.delete(self.events, indices)
-
-    #self.events = np.delete(self.events, indices, axis=0)
-    self.nhits = np.delete(self.nhits, indices, axis=0)
-    #self.event_keys = np.delete(self.event_keys, indices)
-    self.nevents -= len(indices[0])
-
-    for i in indices[0][::-1]:
-      #print('Deleting', i)
-      self.delete_event(i)
-
-  def delete_event(self, i):
-    del self.plane0_time[i]
-    del self.plane0_wire[i]
-    del self.plane0_integral[i]
-
-    del self.plane1_time[i]
-    del self.plane1_wire[i]
-    del self.plane1_integral[i]
-
-    del self.plane2_time[i]
-    del self.plane2_wire[i]
-    del self.plane2_integral[i]
+    ##Drops events that are not beam pi+/mu+ or (with check_nhits) that
+    ##have an empty plane. Returns the number of events each criterion hit
+    criteria = clean_criteria(self.nhits, [0, 1, 2], self.pdg, check_nhits)
+    select_events(self, report_criteria(criteria, self.nevents))
+    return {n: int(np.count_nonzero(c)) for n, c in criteria.items()}
 
   def get_nbatches(self, batchsize=2):
     return ceil(self.nevents/batchsize)
@@ -0,0 +1,106 @@
+import numpy as np
+from multiprocessing import shared_memory
+from hit_store import PlaneStore
+
+##One copy of an ingested PDSPData for all processes of a node.
+##SharedPDSPData moves the arrays of a PDSPData (per-event columns and
+##plane stores) into one named shared memory segment and leaves the
+##PDSPData viewing it. Pickled (e.g. into mp.spawn ranks), it only carries
+##the segment's name and the arrays' layout: the other process attaches to
+##the segment and gets the same kind of PDSPData, viewing the same memory.
+##DataLoader workers are forked and need nothing of this.
+##Arrays are read-only once shared: share after cleaning/selection, which
+##would otherwise make private copies again. The process that shared the
+##data owns the segment and removes it with close()
+
+##Byte alignment of each array in the segment
+ALIGN = 64
+
+def shared_arrays(pdsp_data):
+  ##Every array of pdsp_data by name; plane columns are plane<N>.<column>
+  ##as in a cache directory (see pdsp_cache)
+  arrays = {n: a for n, a in vars(pdsp_data).items()
+            if isinstance(a, np.ndarray)}
+  for pid, plane in enumerate(getattr(pdsp_data, 'planes', [])):
+    if plane is None: continue
+    arrays[f'plane{pid}.offsets'] = plane.offsets
+    for n, c in plane.columns.items():
+      arrays[f'plane{pid}.{n}'] = c
+  return arrays
+
+def view_arrays(pdsp_data, views):
+  ##Points the arrays of pdsp_data at views (see shared_arrays)
+  planes = {}
+  for n, v in views.items():
+    v.flags.writeable = False
+    if '.' not in n:
+      setattr(pdsp_data, n, v)
+      continue
+    pid, column = n[len('plane'):].split('.', 1)
+    planes.setdefault(int(pid), {})[column] = v
+  pdsp_data.planes = [None, None, None]
+  for pid, columns in planes.items():
+    offsets = columns.pop('offsets')
+    pdsp_data.planes[pid] = PlaneStore(columns, offsets)
+
+class SharedPDSPData:
+  ##Stand-in for pdsp_data (process_hits or process_all_hits) whose arrays
+  ##live in shared memory. Everything else is pdsp_data's own
+  def __init__(self, pdsp_data):
+    arrays = shared_arrays(pdsp_data)
+    self.layout, size = {}, 0
+    for n, a in arrays.items():
+      self.layout[n] = (size, a.dtype.str, a.shape)
+      size += -(-a.nbytes//ALIGN)*ALIGN
+    self.segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    self.owner = True
+
+    views = self.views()
+    for n, a in arrays.items(): views[n][...] = a
+    ##pdsp_data lets go of its private copies here
+    view_arrays(pdsp_data, views)
+    self.data = pdsp_data
+
+  def views(self):
+    return {
+      n: np.ndarray(shape, dtype=dtype, buffer=self.segment.buf, offset=start)
+      for n, (start, dtype, shape) in self.layout.items()
+    }
+
+  def __getstate__(self):
+    arrays = shared_arrays(self.data)
+    attrs = {n: a for n, a in vars(self.data).items()
+             ##event_index is a lookup cache, rebuilt on use
+             if n not in arrays and n not in ['planes', 'event_index']}
+    return {
+      'name': self.segment.name,
+      'layout': self.layout,
+      'cls': type(self.data),
+      'attrs': attrs,
+    }
+
+  def __setstate__(self, state):
+    self.layout = state['layout']
+    self.segment = shared_memory.SharedMemory(name=state['name'])
+    self.owner = False
+    data = state['cls'].__new__(state['cls'])
+    data.__dict__.update(state['attrs'])
+    view_arrays(data, self.views())
+    self.data = data
+
+  def __getattr__(self, name):
+    ##Everything but the segment is pdsp_data's
+    if name.startswith('__') or 'data' not in self.__dict__:
+      raise AttributeError(name)
+    return getattr(self.data, name)
+
+  def close(self):
+    ##Detaches this process from the segment; the owner also removes it.
+    ##Arrays taken from the data must not be used afterwards
+    self.__dict__.pop('data', None)
+    try:
+      self.segment.close()
+    except BufferError:
+      ##Views are still held elsewhere -- unmapped when the process ends
+      pass
+    if self.owner: self.segment.unlink()
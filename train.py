@@ -6,6 +6,7 @@ import MinkowskiEngine as ME
 import time, calendar
 #from resnet_mink import Model
 import pdsp_dataset_mink as pdm
+from pdsp_prefetch import Prefetcher, to_device
 
 import torch
 from torch import nn
@@ -26,7 +27,8 @@ class Trainer:
                load=None,
                validate=False,
                batch_size=2,
-               flatten_out=False):
+               flatten_out=False,
+               prefetch_depth=2):
     self.rank=rank
     self.weights=weights
     self.schedule=schedule
@@ -36,9 +38,16 @@ class Trainer:
     self.flatten_out=flatten_out
     self.stored_truths=False
     self.stored_val_truths=False
+    ##Batches whose inputs are built ahead (see pdsp_prefetch)
+    self.prefetch_depth=prefetch_depth
 
     self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+  def unpack_data(self, data):
+    locs, features = data['coordinates'], data['features']
+    return ME.SparseTensor(to_device(features, self.device),
+                           to_device(locs, self.device), device=self.device)
+
   def setup_trainers(self, model_type=0, lr=1.e-3):
     if model_type == 0:
       import resnet_mink
@@ -107,12 +116,14 @@ class Trainer:
     if not self.flatten_out: self.truths.append([])
     #for batch, (locs, features, y) in enumerate(loader):
     end = datetime.now()
-    for batch, data in enumerate(loader):
+    batches = Prefetcher(loader, self.unpack_data, self.prefetch_depth,
+                         self.device)
+    for batch, (data, the_input) in enumerate(batches):
         #loader.get_training_batches(batch_size=self.batch_size)):
       begin = datetime.now()
       print('iterate:', begin - end)
       if max_iter > 0 and batch >= max_iter: break
-      locs, features, y = data['coordinates'], data['features'], data['labels']
+      y = data['labels']
       print('loading data', datetime.now() - begin)
   
       #Zero out gradients
@@ -124,12 +135,6 @@ class Trainer:
       # Compute prediction error
       #pred = self.model(x.float().to(rank))
       #loss = self.loss_fn(pred, y.long().argmax(1).to(rank))
-      p1 = datetime.now()
-      the_input = ME.SparseTensor(features, locs, device=self.device)
-      p2 = datetime.now()
-      delta_input = get_ms_delta(p1, p2)
-
-
       start = datetime.now()
       pred = self.model(the_input)
       end1 = datetime.now()
@@ -177,8 +182,9 @@ class Trainer:
       p2 = datetime.now()
       delta_save = get_ms_delta(p1, p2)
       print(f"\tzerograd: {delta_grad} backprop: {delta_backward} step: {delta_step} save: {delta_save}")
-      print(f"\tloss_check: {delta_loss_check} input: {delta_input}")
+      print(f"\tloss_check: {delta_loss_check}")
       end = datetime.now()
+    batches.report()
     self.stored_truths = True
     
   def validate_loop(self, loader, max_iter=-1):
@@ -192,12 +198,13 @@ class Trainer:
     correct = 0
     
     with torch.no_grad():
-      for batch, data in enumerate(loader):
+      batches = Prefetcher(loader, self.unpack_data, self.prefetch_depth,
+                           self.device)
+      for batch, (data, the_input) in enumerate(batches):
         if max_iter > 0 and batch >= max_iter: break
-        locs, features, y = data['coordinates'], data['features'], data['labels']
+        y = data['labels']
         # Compute prediction error
   
-        the_input = ME.SparseTensor(features, locs, device=self.device)
         pred = self.model(the_input)
         loss = self.loss_fn(pred.features, y.to(self.device))
 
@@ -219,6 +226,7 @@ class Trainer:
           self.val_truths[-1].append(y)
         #print(f"loss: {loss:>7f}  [{current:>5d}/{size}]")
         if batch % 10 == 0: torch.cuda.empty_cache()
+      batches.report()
  
   
     correct /= (1.*loader.dataset.pdsp_data.nevents)
@@ -300,20 +308,32 @@ if __name__ == '__main__':
   parser.add_argument('--noweight', action='store_false')
   parser.add_argument('--weights', nargs=4, default=[], type=float)
   parser.add_argument('--nload', type=int, default=-1)
+  pdm.add_loader_args(parser)
   args = parser.parse_args()
-
-  pdsp_data = process_hits.PDSPData(linked=True)
-  if args.nload > 0:
-    pdsp_data.load_h5_mp(args.trainsample, args.nload)
+  selection = process_hits.Selection(link_fraction=args.link_fraction,
+                                     max_events=args.max_events)
+
+  pdsp_data = process_hits.PDSPData(linked=True,
+                                    stats_file=args.ingest_stats)
+  if args.cache_dir:
+    pdsp_data.load_cached(args.trainsample, args.cache_dir, max(args.nload, 0),
+                          selection=selection, planes=[2])
+  elif args.nload > 0:
+    pdsp_data.load_h5_mp(args.trainsample, args.nload, selection, planes=[2])
   else:
-    pdsp_data.load_h5(args.trainsample)
+    pdsp_data.load_h5(args.trainsample, selection, planes=[2])
   pdsp_data.clean_events()
 
   loader = pdm.get_loader(pdsp_data, args)
 
   if args.validatesample:
-    validate_data = process_hits.PDSPData(linked=True)
-    validate_data.load_h5(args.validatesample)
+    validate_data = process_hits.PDSPData(
+        linked=True, stats_file=args.ingest_stats)
+    if args.cache_dir:
+      validate_data.load_cached(args.validatesample, args.cache_dir,
+                                selection=selection, planes=[2])
+    else:
+      validate_data.load_h5(args.validatesample, selection, planes=[2])
     validate_data.clean_events()
     val_loader = pdm.get_loader(validate_data, args)
   else:
@@ -325,7 +345,8 @@ if __name__ == '__main__':
   print(weights)
 
   trainer = Trainer(batch_size=args.batch_size,
-                    weights=weights)
+                    weights=weights,
+                    prefetch_depth=args.prefetch_depth)
   trainer.setup_trainers()
   trainer.setup_output()
   #trainer.train(pdsp_data, validate_data=validate_data, epochs=args.epochs)
@@ -11,10 +11,11 @@ import numpy as np
 from argparse import ArgumentParser as ap
 
 import torch.multiprocessing as mp
-from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group, barrier
 import os
+from pdsp_prefetch import Prefetcher, to_device
+from pdsp_dataset_mink import add_loader_args
 
 
 def ddp_setup(rank, world_size):
@@ -39,6 +40,7 @@ class Trainer:
                flatten_out=False,
                noddp=False,
                model_type=0, 
+               prefetch_depth=2,
               ):
     self.rank=rank
     self.weights=weights
@@ -51,6 +53,8 @@ class Trainer:
     self.stored_val_truths=False
     self.noddp=noddp
     self.model_type=model_type
+    ##Batches whose inputs are built ahead (see pdsp_prefetch)
+    self.prefetch_depth=prefetch_depth
 
     self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -118,18 +122,23 @@ class Trainer:
     self.val_accs = []
     
   def unpack_data(self, data):
+    ##Runs on the prefetch thread (see pdsp_prefetch)
     if self.model_type != 1: 
       locs, features = data['coordinates'], data['features']
-      return ME.SparseTensor(features, locs, device=self.rank)
+      return ME.SparseTensor(to_device(features, self.rank),
+                             to_device(locs, self.rank), device=self.rank)
     else:
       locs0, features0 = data['coordinates_0'], data['features_0']
-      input0 = ME.SparseTensor(features0, locs0, device=self.rank)
+      input0 = ME.SparseTensor(to_device(features0, self.rank),
+                               to_device(locs0, self.rank), device=self.rank)
 
       locs1, features1 = data['coordinates_1'], data['features_1']
-      input1 = ME.SparseTensor(features1, locs1, device=self.rank)
+      input1 = ME.SparseTensor(to_device(features1, self.rank),
+                               to_device(locs1, self.rank), device=self.rank)
 
       locs2, features2 = data['coordinates_2'], data['features_2']
-      input2 = ME.SparseTensor(features2, locs2, device=self.rank)
+      input2 = ME.SparseTensor(to_device(features2, self.rank),
+                               to_device(locs2, self.rank), device=self.rank)
 
       return (input0, input1, input2)
       
@@ -145,11 +154,11 @@ class Trainer:
     self.preds.append([])
     if not self.flatten_out: self.truths.append([])
 
-    for batch, data in enumerate(loader):
+    batches = Prefetcher(loader, self.unpack_data, self.prefetch_depth,
+                         self.rank)
+    for batch, (data, the_input) in enumerate(batches):
       if max_iter > 0 and batch >= max_iter: break
       y = data['labels']
-
-      the_input = self.unpack_data(data)
   
       #Zero out gradients
       self.optimizer.zero_grad()
@@ -186,6 +195,7 @@ class Trainer:
         if not self.stored_truths:
           self.truths[-1].append(y)
       self.losses[-1].append(loss)
+    batches.report()
     self.stored_truths = True
     
   def validate_loop(self, loader, max_iter=-1):
@@ -199,13 +209,14 @@ class Trainer:
     correct = 0
     
     with torch.no_grad():
-      for batch, data in enumerate(loader):
+      batches = Prefetcher(loader, self.unpack_data, self.prefetch_depth,
+                           self.rank)
+      for batch, (data, the_input) in enumerate(batches):
         if max_iter > 0 and batch >= max_iter: break
         #locs, features, y = data['coordinates'], data['features'], data['labels']
         y = data['labels']
         # Compute prediction error
 
-        the_input = self.unpack_data(data)
         #the_input = ME.SparseTensor(features, locs, device=self.rank)
         #print(the_input.device)
         if self.noddp:
@@ -234,10 +245,12 @@ class Trainer:
           self.val_truths[-1].append(y)
         if not self.stored_val_truths:
           if self.model_type != 1:
+            locs = data['coordinates']
             self.val_locs += [i for i in locs.numpy()]
             indices = set([i for i in locs.numpy()[:, 0]])
             self.val_nhits += [len(np.where(locs.numpy()[:, 0] == i)[0]) for i in indices]
         print(f"loss: {loss:>7f}  [{current:>5d}/{size}]")
+      batches.report()
   
     correct /= (1.*loader.dataset.pdsp_data.nevents)
     self.val_accs.append(correct)
@@ -254,6 +267,9 @@ class Trainer:
   def train(self, train_data, validate_data=None, epochs=1):
     for e in range(epochs):
       print('Start epoch', e)
+      ##Distributed samplers reshuffle (the same way on every rank) by epoch
+      for s in [train_data.sampler, train_data.batch_sampler]:
+        if hasattr(s, 'set_epoch'): s.set_epoch(e)
 
       self.train_loop(train_data)
       #if (e % save_every == 0 or e == epochs-1) and rank == 0:
@@ -320,6 +336,35 @@ def get_weights(pdsp_data, args):
 
   return pdsp_data.get_sample_weights()
 
+def model_planes(args):
+  ##Planes whose hits the model of args.type reads
+  return [0, 1, 2] if args.type == 1 else [2]
+
+def load_sample(pdsp_data, filename, args, selection=None):
+  ##Ingests filename the way the command line asks for. Returns what the
+  ##dataset should wrap: pdsp_data itself, or the mapped cache with --mmap
+  pdsp_data.stats_file = args.ingest_stats
+  planes = model_planes(args)
+  if args.mmap:
+    import pdsp_cache
+    path = pdsp_data.load_cached(filename, args.cache_dir, args.nload,
+                                 load=False, selection=selection,
+                                 planes=planes)
+    return pdsp_cache.MappedPDSPData(path)
+  elif args.cache_dir:
+    pdsp_data.load_cached(filename, args.cache_dir, args.nload,
+                          selection=selection, planes=planes)
+  else:
+    pdsp_data.load_h5_mp(filename, args.nload, selection, planes)
+  return pdsp_data
+
+def share_sample(pdsp_data, args):
+  ##DDP ranks attach to one shared copy of a sample held in RAM instead of
+  ##each unpickling its own (the OS already shares a mapped cache)
+  if args.noddp or args.mmap: return pdsp_data
+  import shared_data
+  return shared_data.SharedPDSPData(pdsp_data)
+
 def train(rank: int,
           args,
           weights,
@@ -336,27 +381,27 @@ def train(rank: int,
     import pdsp_dataset_mink as pdm
   else:
     import pdsp_dataset_mink_allhits as pdm
+  from pdsp_dataset_mink import loader_options, batch_options
+  pids = [0, 1, 2] if args.type == 1 else [2]
 
   loader = pdm.DataLoader(
       train_dataset,
-      batch_size=args.batch_size,
-      shuffle=False,
-      num_workers=0,
       collate_fn=(pdm.minkowski_collate_fn
                   if args.type != 1
                   else pdm.minkowski_collate_fn_all_planes),
-      sampler=(None if args.noddp else DistributedSampler(train_dataset)),
+      **batch_options(train_dataset, args, pids, distributed=not args.noddp),
+      **loader_options(args),
   )
   if val_dataset is None:
     val_loader = None
   else:
     val_loader = pdm.DataLoader(
       val_dataset,
-      batch_size=args.batch_size,
-      shuffle=False,
       collate_fn=(pdm.minkowski_collate_fn
                   if args.type != 1
                   else pdm.minkowski_collate_fn_all_planes),
+      **batch_options(val_dataset, args, pids),
+      **loader_options(args),
     )
 
   trainer = Trainer(
@@ -367,6 +412,7 @@ def train(rank: int,
       flatten_out=True,
       noddp=args.noddp,
       model_type=args.type,
+      prefetch_depth=args.prefetch_depth,
   )
 
   trainer.setup_trainers(lr=args.lr)
@@ -397,7 +443,13 @@ if __name__ == '__main__':
                             '1 -- Beam/Cosmic Hits'))
   parser.add_argument('--noddp', action='store_true')
   parser.add_argument('--schedule', action='store_true')
+  parser.add_argument('--mmap', action='store_true',
+                      help=('Read events on demand from the memory-mapped '
+                            'cache instead of RAM (needs --cache_dir)'))
+  add_loader_args(parser, num_workers=0)
   args = parser.parse_args()
+  if args.mmap and not args.cache_dir:
+    parser.error('--mmap needs --cache_dir')
 
   if args.type == 0:
     import pdsp_dataset_mink as pdm
@@ -417,9 +469,12 @@ if __name__ == '__main__':
     from pdsp_dataset_mink_allhits import get_dataset
     pdsp_data = process_hits.PDSPData(nfeatures=2)
 
+  selection = process_hits.Selection(link_fraction=args.link_fraction,
+                                     max_events=args.max_events)
 
-  pdsp_data.load_h5_mp(args.trainsample, args.nload)
+  pdsp_data = load_sample(pdsp_data, args.trainsample, args, selection)
   pdsp_data.clean_events()
+  pdsp_data = share_sample(pdsp_data, args)
 
   pdsp_dataset = get_dataset(pdsp_data)
 
@@ -429,10 +484,13 @@ if __name__ == '__main__':
     else:
       validate_data = process_hits.PDSPData(nfeatures=2)
 
-    validate_data.load_h5_mp(args.validatesample, args.nload)
+    validate_data = load_sample(validate_data, args.validatesample, args,
+                                selection)
     validate_data.clean_events()
+    validate_data = share_sample(validate_data, args)
     val_dataset = get_dataset(validate_data)
   else:
+    validate_data = None
     val_dataset = None
  
   weights = get_weights(pdsp_data, args)
@@ -440,14 +498,19 @@ if __name__ == '__main__':
 
   if not args.noddp:
     world_size = torch.cuda.device_count() if torch.cuda.is_available else 1
-    mp.spawn(train,
-      args=(
-        args,
-        weights,
-        world_size,
-        pdsp_dataset,
-        val_dataset,
-      ), nprocs=world_size
-    )
+    try:
+      mp.spawn(train,
+        args=(
+          args,
+          weights,
+          world_size,
+          pdsp_dataset,
+          val_dataset,
+        ), nprocs=world_size
+      )
+    finally:
+      ##Removes the shared samples even if a rank failed
+      for d in [pdsp_data, validate_data]:
+        if hasattr(d, 'close'): d.close()
   else:
    train(0, args, weights, 1, pdsp_dataset, val_dataset) 
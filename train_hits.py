@@ -3,6 +3,7 @@ import torch
 from argparse import ArgumentParser as ap
 
 import pdsp_dataset_mink_allhits as pdm
+from pdsp_dataset_mink import add_loader_args
 
 
 if __name__ == '__main__':
@@ -17,18 +18,32 @@ if __name__ == '__main__':
   parser.add_argument('--noweight', action='store_false')
   parser.add_argument('--weights', nargs=4, default=[], type=float)
   parser.add_argument('--nload', type=int, default=1)
+  add_loader_args(parser)
 
   args = parser.parse_args()
 
   import process_all_hits
-  pdsp_data = process_all_hits.PDSPData(nfeatures=2)
-  pdsp_data.load_h5_mp(args.trainsample, args.nload)
+  selection = process_all_hits.Selection(link_fraction=args.link_fraction,
+                                         max_events=args.max_events)
+  pdsp_data = process_all_hits.PDSPData(nfeatures=2,
+                                        stats_file=args.ingest_stats)
+  if args.cache_dir:
+    pdsp_data.load_cached(args.trainsample, args.cache_dir, args.nload,
+                          selection=selection, planes=[2])
+  else:
+    pdsp_data.load_h5_mp(args.trainsample, args.nload, selection, planes=[2])
 
   loader = pdm.get_loader(pdsp_data, args)
 
   if args.validatesample:
-    validate_data = process_all_hits.PDSPData(nfeatures=2)
-    validate_data.load_h5_mp(args.validatesample, args.nload)
+    validate_data = process_all_hits.PDSPData(
+        nfeatures=2, stats_file=args.ingest_stats)
+    if args.cache_dir:
+      validate_data.load_cached(args.validatesample, args.cache_dir, args.nload,
+                                selection=selection, planes=[2])
+    else:
+      validate_data.load_h5_mp(args.validatesample, args.nload, selection,
+                               planes=[2])
     val_loader = pdm.get_loader(validate_data, args)
   else:
     #validate_data = None
@@ -40,7 +55,8 @@ if __name__ == '__main__':
 
   trainer = train.Trainer(batch_size=args.batch_size,
                           weights=weights,
-                          flatten_out=True)
+                          flatten_out=True,
+                          prefetch_depth=args.prefetch_depth)
   trainer.setup_trainers(model_type=1, lr=1.e-2)
   trainer.setup_output()
   #trainer.train(pdsp_data, validate_data=validate_data, epochs=args.epochs)